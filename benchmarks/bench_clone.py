@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+"""
+Measure vbox-clone-vm against the fake VBoxManage in benchmarks/fakevbox,
+so no VirtualBox install is needed.  For each inventory size a fresh
+synthetic inventory is generated, then createHDDForest(), getVM(),
+setinfofrom() and a whole clone through the script are timed, along with
+the number of times VBoxManage was started for each.  setinfofrom() is
+timed once more with the fake run in this process through a FakeBackend,
+which shows how much of its time goes on starting VBoxManage.
+
+Run from the top of the source tree:
+
+    PYTHONPATH=src python3 benchmarks/bench_clone.py [--disks 1000,10000]
+        [--depth N] [--controllers N] [--vms N] [--latency SECONDS]
+
+The fake's own start-up and JSON parsing is part of every command's
+time, so the numbers are most useful compared with each other, and with
+--latency set to what a real VBoxManage costs on the machine of interest.
+"""
+
+import argparse
+import contextlib
+import importlib.machinery
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import types
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+FAKEVBOX = os.path.join(HERE, "fakevbox")
+SCRIPT = os.path.join(HERE, os.pardir, "scripts", "vbox-clone-vm")
+
+def setupenvironment(directory, args, disks):
+    "Point VBoxManage, the cache and VBOX_USER_HOME at the fake in directory."
+    statefile = os.path.join(directory, "state.json")
+    os.environ["PATH"] = FAKEVBOX + os.pathsep + os.environ["PATH"]
+    os.environ["FAKEVBOX_STATE"] = statefile
+    os.environ["FAKEVBOX_VMS"] = str(args.vms)
+    os.environ["FAKEVBOX_DISKS"] = str(disks)
+    os.environ["FAKEVBOX_DEPTH"] = str(args.depth)
+    os.environ["FAKEVBOX_CONTROLLERS"] = str(args.controllers)
+    os.environ["FAKEVBOX_LATENCY"] = str(args.latency)
+    os.environ["VBOX_USER_HOME"] = directory
+    os.environ["XDG_CACHE_HOME"] = os.path.join(directory, "cache")
+    return statefile + ".calls"
+
+def countcalls(callsfile):
+    "Return the number of times VBoxManage has been started so far."
+    if not os.path.exists(callsfile):
+        return 0
+    with open(callsfile) as f:
+        return sum(1 for line in f)
+
+class Measurement:
+    """
+    Times a block and counts the VBoxManage commands started in it, as
+    launches or, if they are run in this process, commands.
+    """
+    def __init__(self, name, callsfile, what="launches"):
+        self.name = name
+        self.callsfile = callsfile
+        self.what = what
+
+    def __enter__(self):
+        self.calls = countcalls(self.callsfile)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.seconds = time.perf_counter() - self.start
+        self.calls = countcalls(self.callsfile) - self.calls
+
+    def __str__(self):
+        return "  %-16s %10.3f s %8d %s" % (self.name, self.seconds, self.calls, self.what)
+
+class InProcessFake:
+    """
+    Runs the fake VBoxManage in this process, as the handler of a
+    FakeBackend.  Commands are run one at a time, since the fake prints
+    to sys.stdout and sys.stderr.
+    """
+    def __init__(self):
+        loader = importlib.machinery.SourceFileLoader("fakevbox",
+                os.path.join(FAKEVBOX, "VBoxManage"))
+        self.module = types.ModuleType(loader.name)
+        loader.exec_module(self.module)
+        self.lock = threading.Lock()
+
+    def __call__(self, args):
+        "Run the fake with args and return its stdout and stderr."
+        stdout = io.StringIO()
+        stderr = io.StringIO()
+        with self.lock:
+            argv = sys.argv
+            sys.argv = ["VBoxManage"] + list(args)
+            try:
+                with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+                    try:
+                        self.module.main()
+                    except SystemExit:
+                        pass
+            finally:
+                sys.argv = argv
+        return stdout.getvalue(), stderr.getvalue()
+
+def benchmark(args, disks):
+    # imported here so that the modules see the environment set up above
+    from vboxclonevm.backend import FakeBackend, getbackend, setbackend
+    from vboxclonevm.hdd import createHDDForest
+    from vboxclonevm.utils import mediacatalog
+    from vboxclonevm.vm import createNewVM, getVM
+
+    directory = tempfile.mkdtemp(prefix="bench-clone-")
+    try:
+        callsfile = setupenvironment(directory, args, disks)
+        print("%d disks, chains of %d, %d vms, %d controllers, %.3f s latency:" % (
+            disks, args.depth, args.vms, args.controllers, args.latency))
+
+        # generate the inventory first so it isn't counted
+        subprocess.run(["VBoxManage", "list", "vms"], stdout=subprocess.DEVNULL, check=True)
+        mediacatalog.invalidate()
+
+        measurements = [Measurement(name, callsfile) for name in
+                ["createHDDForest", "getVM", "setinfofrom", "full clone"]]
+        measurements.append(Measurement("in-process", callsfile, "commands"))
+        quiet = io.StringIO()
+        with contextlib.redirect_stdout(quiet):
+            with measurements[0]:
+                forest = createHDDForest()
+            with measurements[1]:
+                vms = getVM(forest)
+            vm = [vm for vm in vms if vm.name == "vm0"][0]
+            with measurements[2]:
+                vm.fillininfo()
+                newvm = createNewVM("bench-setinfofrom", vm.ostype(), forest)
+                newvm.setinfofrom(vm)
+            with measurements[3]:
+                subprocess.run([sys.executable, SCRIPT, "vm1", "bench-clone"],
+                        stdout=subprocess.DEVNULL, check=True)
+
+            # the same as setinfofrom above, without starting anything
+            backend = getbackend()
+            setbackend(FakeBackend(handler=InProcessFake()))
+            try:
+                mediacatalog.invalidate()
+                vm.invalidateinfo()
+                with measurements[4]:
+                    vm.fillininfo()
+                    newvm = createNewVM("bench-inprocess", vm.ostype(), forest)
+                    newvm.setinfofrom(vm)
+            finally:
+                setbackend(backend)
+        for measurement in measurements:
+            print(measurement)
+    finally:
+        shutil.rmtree(directory)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark vbox-clone-vm with a fake VBoxManage.")
+    parser.add_argument('--disks', default="1000,10000",
+            help="comma separated numbers of hard disks to try (default 1000,10000)")
+    parser.add_argument('--depth', type=int, default=1, help="length of differencing chains")
+    parser.add_argument('--controllers', type=int, default=2, help="storage controllers per vm")
+    parser.add_argument('--vms', type=int, default=10, help="number of vms")
+    parser.add_argument('--latency', type=float, default=0.0,
+            help="seconds every VBoxManage command sleeps before running")
+    args = parser.parse_args()
+
+    # the full clone runs the script, which needs to find the package too
+    os.environ["PYTHONPATH"] = os.pathsep.join([p for p in sys.path if p])
+
+    for disks in [int(n) for n in args.disks.split(",")]:
+        benchmark(args, disks)
+    sys.exit(0)
+
+if __name__ == '__main__':
+    main()
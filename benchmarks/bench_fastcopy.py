@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+"""
+Compare copying an image file through userspace, as clonehd does, with
+copyimage(), which uses a reflink or copy_file_range().  Prints which
+way copyimage() used on the filesystem of DIRECTORY, so it also shows
+whether --fast-copy will help there.  Both copies are checked byte for
+byte against the original, and so is a copy_file_range() copy in chunks
+much smaller than the image, whichever way copyimage() used.
+
+Run from the top of the source tree:
+
+    PYTHONPATH=src python3 benchmarks/bench_fastcopy.py [DIRECTORY [MB]]
+"""
+
+import filecmp
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from vboxclonevm import fastcopy
+from vboxclonevm.fastcopy import copyfilerange, copyimage
+
+# the chunk size for the chunked copy_file_range() copy
+SMALLCHUNK = 1024 * 1024
+
+def check(source, copy):
+    "Exit if the file copy isn't the same as the file source."
+    if not filecmp.cmp(source, copy, shallow=False):
+        print("ERROR! %s is not the same as %s." % (copy, source))
+        sys.exit(1)
+
+def chunkedcopy(source, target):
+    """
+    Copy source to target with copyfilerange() in chunks of SMALLCHUNK.
+    Return how many chunks it took, or None if copy_file_range() isn't
+    supported.
+    """
+    chunks = []
+    chunksize = fastcopy.CHUNKSIZE
+    fastcopy.CHUNKSIZE = SMALLCHUNK
+    try:
+        with open(source, "rb") as fsrc, open(target, "wb") as fdst:
+            if not copyfilerange(fsrc.fileno(), fdst.fileno(), os.fstat(fsrc.fileno()).st_size,
+                    chunks.append):
+                return None
+    finally:
+        fastcopy.CHUNKSIZE = chunksize
+    return len(chunks)
+
+def main():
+    directory = sys.argv[1] if len(sys.argv) > 1 else tempfile.gettempdir()
+    megabytes = int(sys.argv[2]) if len(sys.argv) > 2 else 512
+
+    workdir = tempfile.mkdtemp(prefix="bench-fastcopy-", dir=directory)
+    try:
+        source = os.path.join(workdir, "source.vdi")
+        with open(source, "wb") as f:
+            # every megabyte is different, and the last chunk isn't a
+            # whole one, so chunks copied to the wrong place show up
+            chunk = os.urandom(1024 * 1024)
+            for i in range(megabytes):
+                f.write(i.to_bytes(8, "little") + chunk[8:])
+            f.write(chunk[:12345])
+            os.fsync(f.fileno())
+
+        start = time.perf_counter()
+        with open(source, "rb") as fsrc, open(os.path.join(workdir, "userspace.vdi"), "wb") as fdst:
+            # copyfileobj, unlike copyfile, never uses sendfile()
+            shutil.copyfileobj(fsrc, fdst, 1024 * 1024)
+            os.fsync(fdst.fileno())
+        userspace = time.perf_counter() - start
+
+        start = time.perf_counter()
+        method = copyimage(source, os.path.join(workdir, "fast.vdi"))
+        fast = time.perf_counter() - start
+
+        print("%d MB in %s" % (megabytes, directory))
+        print("userspace copy      %8.3f s" % userspace)
+        print("copyimage (%s) %8.3f s" % (method or "unsupported", fast))
+
+        check(source, os.path.join(workdir, "userspace.vdi"))
+        if method is not None:
+            check(source, os.path.join(workdir, "fast.vdi"))
+        print("The copies are the same as the original.")
+        chunks = chunkedcopy(source, os.path.join(workdir, "chunked.vdi"))
+        if chunks is not None:
+            check(source, os.path.join(workdir, "chunked.vdi"))
+            print("So is a copy_file_range() copy in %d chunks." % chunks)
+    finally:
+        shutil.rmtree(workdir)
+    sys.exit(0)
+
+if __name__ == '__main__':
+    main()
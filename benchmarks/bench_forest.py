@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+"""
+Check that building and querying a Forest scales linearly with the number
+of hdds.  Builds synthetic forests of differencing disk chains and prints
+the time per node for each size.  Also times summing up every tree, and
+summing them up again after one disk is added, which only has to redo
+the tree the disk was added to.
+
+Run from the top of the source tree:
+
+    PYTHONPATH=src python3 benchmarks/bench_forest.py
+"""
+
+import sys
+import time
+
+from vboxclonevm.hdd import HDD, Forest
+from vboxclonevm.utils import hddsattachedto
+
+SIZES = [10000, 30000, 100000]
+CHAIN_LENGTH = 5
+VMS = 100
+
+def hddlines(i):
+    "Return the `VBoxManage list hdds` lines for the i-th synthetic hdd."
+    uuid = "00000000-0000-0000-0000-%012d" % i
+    if i % CHAIN_LENGTH == 0:
+        parentuuid = "base"
+    else:
+        parentuuid = "00000000-0000-0000-0000-%012d" % (i - 1)
+    lines = ["UUID:           %s" % uuid,
+            "Parent UUID:    %s" % parentuuid,
+            "Format:         VDI",
+            "Location:       /vms/disk-%d.vdi" % i,
+            "State:          created",
+            "Type:           normal"]
+    if i % CHAIN_LENGTH == CHAIN_LENGTH - 1:
+        vm = i % VMS
+        lines.append("Usage:          vm%d (UUID: 11111111-0000-0000-0000-%012d)" % (vm, vm))
+    return lines
+
+def bench(size):
+    """
+    Time building, querying and summing up the trees of a forest of size
+    nodes, and summing them up again after adding a node.
+    """
+    hdds = [hddlines(i) for i in range(size)]
+    # insert children before their parents half of the time
+    hdds = hdds[::2] + hdds[1::2]
+
+    start = time.perf_counter()
+    forest = Forest()
+    for lines in hdds:
+        hdd = HDD(lines, forest)
+        forest[hdd.uuid] = hdd
+    build = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ends = forest.getends()
+    attached = [hddsattachedto("vm%d" % vm, forest) for vm in range(VMS)]
+    query = time.perf_counter() - start
+
+    assert(len(ends) == size // CHAIN_LENGTH)
+    assert(sum(len(a) for a in attached) == len(ends))
+
+    start = time.perf_counter()
+    summaries = [forest.getsummary(root.uuid) for root in forest.getroots()]
+    rollup = time.perf_counter() - start
+    assert(sum(summary.nodes for summary in summaries) == size)
+
+    lines = hddlines(size)
+    lines[1] = "Parent UUID:    %s" % ends[0].uuid
+    hdd = HDD(lines, forest)
+    forest[hdd.uuid] = hdd
+    start = time.perf_counter()
+    summaries = [forest.getsummary(root.uuid) for root in forest.getroots()]
+    update = time.perf_counter() - start
+    assert(sum(summary.nodes for summary in summaries) == size + 1)
+
+    return build, query, rollup, update
+
+def main():
+    for size in SIZES:
+        build, query, rollup, update = bench(size)
+        print("%7d hdds: build %.3fs (%.2fus/hdd), query %.3fs (%.2fus/hdd), "
+                "sum up trees %.3fs, again after adding one %.3fs" %
+                (size, build, build / size * 1e6, query, query / size * 1e6, rollup, update))
+    sys.exit(0)
+
+if __name__ == '__main__':
+    main()
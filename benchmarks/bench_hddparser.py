@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+"""
+Compare the streaming `VBoxManage list hdds` parser against the old parser
+that read all the output into one string and ran a regex per field.
+Prints the time and peak memory of each for a synthetic list of hdds.
+
+Run from the top of the source tree:
+
+    PYTHONPATH=src python3 benchmarks/bench_hddparser.py [NUMBER_OF_HDDS]
+"""
+
+import re
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from vboxclonevm.hdd import iterHDDs
+
+class OldHDD:
+    "The hdd record as it was parsed before iterHDDs()."
+    def __init__(self, lines):
+        self.uuid = re.sub(r'^UUID:\W+', '', lines[0])
+        self.parentuuid = re.sub(r'^Parent UUID:\W+', '', lines[1])
+        self.hdformat = re.sub(r'^Format:\W+', '', lines[2])
+        self.hdlocation = re.sub(r'^Location:\s+', '', lines[3])
+        self.hdstate = re.sub(r'^State:\W+', '', lines[4])
+        self.hdtype = re.sub(r'^Type:\W+', '', lines[5])
+        self.hdusage = None
+        self.hdvm = None
+        self.hdvmuuid = None
+        self.hdsnapshot = None
+        self.hdsnapshotuuid = None
+        if len(lines) == 7:
+            self.hdusage = re.sub(r'^Usage:\W+', '', lines[6])
+            m = re.match(r'^(.*?) \(UUID: ([\w\d-]+)\)$', self.hdusage)
+            self.hdvm = m.group(1)
+            self.hdvmuuid = m.group(2)
+        self.forest = None
+        self.parent = None
+
+def listhdds(size):
+    "Return synthetic `VBoxManage list hdds` output for size hdds."
+    blocks = []
+    for i in range(size):
+        lines = ["UUID:           00000000-0000-0000-0000-%012d" % i,
+                "Parent UUID:    base",
+                "Format:         VDI",
+                "Location:       /vms/vm%d/disk-%d.vdi" % (i, i),
+                "State:          created",
+                "Type:           normal",
+                "Usage:          vm%d (UUID: 11111111-0000-0000-0000-%012d)" % (i, i)]
+        blocks.append("\n".join(lines))
+    return "\n\n".join(blocks) + "\n"
+
+def oldparse(output):
+    "Parse hdds the old way, reading all of output into one string first."
+    stdout = output.read()
+    return [OldHDD(block.strip().split("\n")) for block in stdout.strip().split("\n\n")]
+
+def newparse(output):
+    "Parse hdds with iterHDDs(), reading output a line at a time."
+    return list(iterHDDs(output))
+
+def measure(parse, filename):
+    """
+    Return the time and peak memory used by parse() reading filename.
+    The time and the memory are measured in separate runs, because
+    tracing memory slows everything down.
+    """
+    with open(filename) as output:
+        start = time.perf_counter()
+        hdds = parse(output)
+        elapsed = time.perf_counter() - start
+    count = len(hdds)
+    del hdds
+
+    with open(filename) as output:
+        tracemalloc.start()
+        hdds = parse(output)
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return elapsed, peak, count
+
+def main():
+    size = 100000
+    if len(sys.argv) > 1:
+        size = int(sys.argv[1])
+
+    with tempfile.NamedTemporaryFile("w", suffix=".txt") as output:
+        output.write(listhdds(size))
+        output.flush()
+
+        for name, parse in [("old", oldparse), ("streaming", newparse)]:
+            elapsed, peak, count = measure(parse, output.name)
+            assert(count == size)
+            print("%-9s %d hdds: %.3fs, peak memory %.1f MB" %
+                    (name, count, elapsed, peak / 1024.0 / 1024.0))
+    sys.exit(0)
+
+if __name__ == '__main__':
+    main()
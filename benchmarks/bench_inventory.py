@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+
+"""
+Read the inventory both with VBoxManage and from VirtualBox's settings
+files, check that they agree and print how long each took.  Uses
+whatever VBoxManage is first on PATH and VirtualBox.xml in
+VBOX_USER_HOME (or the default place), so it can be pointed at the fake
+VBoxManage in benchmarks/fakevbox too.
+
+Run from the top of the source tree:
+
+    PYTHONPATH=src python3 benchmarks/bench_inventory.py
+"""
+
+import sys
+import time
+
+from vboxclonevm.cache import vboxuserhome
+from vboxclonevm.hdd import createHDDForest
+from vboxclonevm.vm import getVM
+from vboxclonevm.xmlinventory import readinventory
+
+def describe(vms, forest, states=None):
+    """
+    Return what the two ways of reading the inventory should agree on.
+    The settings files don't tell the states of the hdds that vms use,
+    so those are taken from states, the Forest read with VBoxManage.
+    """
+    def state(hdd):
+        if hdd.hdstate is None and states is not None and hdd.uuid in states:
+            return states[hdd.uuid].hdstate
+        return hdd.hdstate
+
+    return (sorted((vm.name, vm.uuid) for vm in vms),
+            sorted((hdd.uuid, hdd.parentuuid, hdd.hdlocation, (hdd.hdformat or "").upper(),
+                state(hdd), hdd.hdtype, hdd.hdvmuuid, hdd.hdsnapshotuuid)
+                for hdd in forest.values()))
+
+def main():
+    start = time.perf_counter()
+    forest = createHDDForest()
+    vms = getVM(forest)
+    vboxmanagetime = time.perf_counter() - start
+
+    start = time.perf_counter()
+    xmlvms, xmlforest = readinventory(vboxuserhome())
+    xmltime = time.perf_counter() - start
+
+    print("%d vms, %d hdds" % (len(vms), len(forest.nodes)))
+    print("VBoxManage  %8.1f ms" % (vboxmanagetime * 1000))
+    print("xml         %8.1f ms" % (xmltime * 1000))
+
+    expected = describe(vms, forest)
+    got = describe(xmlvms, xmlforest, forest)
+    if expected == got:
+        print("The inventories are the same.")
+        sys.exit(0)
+
+    for what, expecteditems, gotitems in zip(["vm", "hdd"], expected, got):
+        for item in sorted(set(expecteditems) - set(gotitems)):
+            print("Only from VBoxManage: %s %s" % (what, item))
+        for item in sorted(set(gotitems) - set(expecteditems)):
+            print("Only from xml: %s %s" % (what, item))
+    sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+"""
+Time how long vbox-clone-vm takes to start up and answer each read-only
+subcommand, with the inventory cache both warm and bypassed.  Uses
+whatever VBoxManage is first on PATH.
+
+Run from the top of the source tree:
+
+    PYTHONPATH=src python3 benchmarks/bench_startup.py [RUNS]
+"""
+
+import os
+import subprocess
+import sys
+import time
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        os.pardir, "scripts", "vbox-clone-vm")
+
+SUBCOMMANDS = [
+        ["--help"],
+        ["--list-vm-names"],
+        ["--list-vms"],
+        ["--list-hdds"],
+        ["--list-vm-names", "--no-cache"],
+        ["--list-vms", "--no-cache"],
+        ["--list-hdds", "--no-cache"],
+        ]
+
+def timecommand(args, runs):
+    "Return the mean wall time in seconds of running args runs times."
+    total = 0.0
+    for i in range(runs):
+        start = time.perf_counter()
+        subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=True)
+        total += time.perf_counter() - start
+    return total / runs
+
+def main():
+    runs = 10
+    if len(sys.argv) > 1:
+        runs = int(sys.argv[1])
+
+    for subcommand in SUBCOMMANDS:
+        args = [sys.executable, SCRIPT] + subcommand
+        # run once so the cache is warm
+        subprocess.run(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        print("%-30s %8.1f ms" % (" ".join(subcommand), timecommand(args, runs) * 1000))
+    sys.exit(0)
+
+if __name__ == '__main__':
+    main()
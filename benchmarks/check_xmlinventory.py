@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+"""
+Read the inventory from the settings files in benchmarks/fixtures/vboxhome,
+which are laid out like VirtualBox's own: a global media registry in
+VirtualBox.xml, a media registry in the .vbox file of a newer vm with its
+storage controllers inside Hardware and disks attached in nested
+snapshots, and an older vm with its storage controllers next to Hardware.
+Check that the vms and hdds are what `VBoxManage list vms` and
+`VBoxManage list hdds` would list, except for the states that can't be
+told from the files.
+
+Run from the top of the source tree:
+
+    PYTHONPATH=src python3 benchmarks/check_xmlinventory.py
+"""
+
+import os
+import sys
+
+from vboxclonevm.xmlinventory import readinventory
+
+HOME = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures", "vboxhome")
+
+WEB = "5f3c2d1e-8a4b-4c6d-9e0f-1a2b3c4d5e01"
+LEGACY = "5f3c2d1e-8a4b-4c6d-9e0f-1a2b3c4d5e02"
+
+EXPECTEDVMS = [("web", WEB), ("legacy", LEGACY)]
+
+# (uuid, parent uuid, location in HOME, format, state, type, vm uuid,
+# snapshot name) of each hdd, in the order VBoxManage lists them.  The
+# hdds that vms use have no state, since they are locked if the vm is
+# running.
+EXPECTEDHDDS = [
+        ("0b7e1c2d-3f4a-4b5c-8d6e-7f8091a2b301", "base", "HardDisks/legacy.vdi",
+            "VDI", None, "normal (base)", LEGACY, None),
+        ("0b7e1c2d-3f4a-4b5c-8d6e-7f8091a2b302", "base", "HardDisks/scratch.vmdk",
+            "VMDK", "created", "writethrough (base)", None, None),
+        ("c1d2e3f4-a5b6-4c7d-8e9f-0a1b2c3d4e01", "base", "VirtualBox VMs/web/web.vdi",
+            "VDI", None, "normal (base)", WEB, "Installed"),
+        ("c1d2e3f4-a5b6-4c7d-8e9f-0a1b2c3d4e02", "c1d2e3f4-a5b6-4c7d-8e9f-0a1b2c3d4e01",
+            "VirtualBox VMs/web/Snapshots/{c1d2e3f4-a5b6-4c7d-8e9f-0a1b2c3d4e02}.vdi",
+            "VDI", None, "normal (differencing)", WEB, "Updated"),
+        ("c1d2e3f4-a5b6-4c7d-8e9f-0a1b2c3d4e03", "c1d2e3f4-a5b6-4c7d-8e9f-0a1b2c3d4e02",
+            "VirtualBox VMs/web/Snapshots/{c1d2e3f4-a5b6-4c7d-8e9f-0a1b2c3d4e03}.vdi",
+            "VDI", None, "normal (differencing)", WEB, None),
+        ("c1d2e3f4-a5b6-4c7d-8e9f-0a1b2c3d4e04", "base", "VirtualBox VMs/web/spare.vdi",
+            "VDI", "created", "normal (base)", None, None),
+        ("c1d2e3f4-a5b6-4c7d-8e9f-0a1b2c3d4e05", "base", "VirtualBox VMs/web/gone.vdi",
+            "VDI", "inaccessible", "normal (base)", None, None),
+        ]
+
+def describe(vms, forest):
+    "Return the vms and hdds in the same form as EXPECTEDVMS and EXPECTEDHDDS."
+    return ([(vm.name, vm.uuid) for vm in vms],
+            [(hdd.uuid, hdd.parentuuid, os.path.relpath(hdd.hdlocation, HOME), hdd.hdformat,
+                hdd.hdstate, hdd.hdtype, hdd.hdvmuuid, hdd.hdsnapshot)
+                for hdd in forest.values()])
+
+def main():
+    vms, forest = readinventory(HOME)
+    gotvms, gothdds = describe(vms, forest)
+
+    failed = False
+    for what, expected, got in [("vm", EXPECTEDVMS, gotvms), ("hdd", EXPECTEDHDDS, gothdds)]:
+        if expected == got:
+            continue
+        failed = True
+        for item in expected:
+            if item not in got:
+                print("Missing %s %s" % (what, item))
+        for item in got:
+            if item not in expected:
+                print("Unexpected %s %s" % (what, item))
+        if sorted(expected) == sorted(got):
+            print("The %ss are in the wrong order." % what)
+
+    if failed:
+        sys.exit(1)
+    print("%d vms and %d hdds as expected." % (len(gotvms), len(gothdds)))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,271 @@
+"""
+Module that runs VBoxManage commands.  Provides the Backend classes and
+functions to choose the backend that runcommand() and friends use.
+
+SubprocessBackend, the default, runs the real VBoxManage.  APIBackend
+answers the read-only commands that are run most often in-process through
+the VirtualBox Python API bindings, and passes everything else on to
+VBoxManage.  FakeBackend answers commands in-process, for benchmarks and
+checks.
+"""
+
+import io
+import os
+import sys
+import threading
+
+from subprocess import Popen, PIPE
+
+class FinishedProcess:
+    """
+    Something that looks like a Popen object, for a command that has
+    already finished.  stdout and stderr are bytes.
+    """
+    def __init__(self, stdout, stderr, returncode=0, stdoutfile=PIPE, stderrfile=PIPE):
+        self.stdout = None
+        self.stderr = None
+        self.returncode = returncode
+
+        if stdoutfile == PIPE:
+            self.stdout = io.BytesIO(stdout)
+        elif stdoutfile is not None:
+            stdoutfile.write(stdout)
+        if stderrfile == PIPE:
+            self.stderr = io.BytesIO(stderr)
+        elif stderrfile is not None:
+            stderrfile.write(stderr)
+
+    def wait(self):
+        return self.returncode
+
+    def poll(self):
+        return self.returncode
+
+    def communicate(self):
+        stdout = self.stdout.read() if self.stdout else None
+        stderr = self.stderr.read() if self.stderr else None
+        return stdout, stderr
+
+class Backend:
+    """
+    Runs commands.  args is always a list like the arguments to
+    subprocess.Popen, starting with "VBoxManage".
+    """
+    def run(self, args):
+        "Run args and return a tuple of its stdout and stderr as strings."
+        raise NotImplementedError
+
+    def popen(self, args, stdout=PIPE, stderr=PIPE):
+        """
+        Start running args and return a Popen-like object.  stdout and
+        stderr are PIPE or a file to write the output to, like for
+        subprocess.Popen.  By default the command is run to completion
+        with run() first, and counts as failed if it wrote to stderr.
+        """
+        out, err = self.run(args)
+        return FinishedProcess(out.encode('utf-8'), err.encode('utf-8'),
+                1 if err else 0, stdout, stderr)
+
+class SubprocessBackend(Backend):
+    "Run every command as a separate process."
+    def run(self, args):
+        stdout, stderr = Popen(args, stdout=PIPE, stderr=PIPE).communicate()
+        return stdout.decode('utf-8'), stderr.decode('utf-8')
+
+    def popen(self, args, stdout=PIPE, stderr=PIPE):
+        return Popen(args, stdout=stdout, stderr=stderr)
+
+class FakeBackend(Backend):
+    """
+    Answer commands from responses, a dict mapping tuples of arguments
+    (without "VBoxManage") to stdout strings or (stdout, stderr) tuples,
+    or from handler, a function that takes the list of arguments and
+    returns a (stdout, stderr) tuple.  Commands that aren't answered get
+    empty output.  Every list of arguments run is recorded in calls.
+    Nothing is started, so set it with setbackend() to see how long
+    things take without the cost of starting VBoxManage.
+    """
+    def __init__(self, responses=None, handler=None):
+        self.responses = responses or {}
+        self.handler = handler
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def run(self, args):
+        with self.lock:
+            self.calls.append(list(args))
+        key = tuple(args[1:])
+        if key in self.responses:
+            response = self.responses[key]
+            if isinstance(response, tuple):
+                return response
+            return response, ""
+        if self.handler:
+            return self.handler(args[1:])
+        return "", ""
+
+class APIBackend(Backend):
+    """
+    Answer `VBoxManage list` and `VBoxManage showhdinfo` through the
+    VirtualBox Python API, in the same format as VBoxManage, so they don't
+    need a new process each time.  Other commands are run by fallback, a
+    SubprocessBackend by default.
+
+    Raises ImportError if the vboxapi module isn't available, and
+    whatever the bindings raise if they can't get to VirtualBox.
+    """
+    def __init__(self, fallback=None):
+        from vboxapi import VirtualBoxManager
+
+        self.fallback = fallback or SubprocessBackend()
+        self.manager = VirtualBoxManager(None, None)
+        self.vbox = self.manager.getVirtualBox()
+        # the API objects aren't safe to use from several threads at once
+        self.lock = threading.RLock()
+
+    def run(self, args):
+        if args[0] != "VBoxManage" or len(args) < 2:
+            return self.fallback.run(args)
+
+        command = args[1:]
+        if len(command) == 2 and command[0] == "list":
+            lister = getattr(self, "_list_%s" % command[1], None)
+            if lister:
+                with self.lock:
+                    return lister(), ""
+        if len(command) == 2 and command[0] == "showhdinfo":
+            with self.lock:
+                return self._showhdinfo(command[1])
+
+        return self.fallback.run(args)
+
+    def popen(self, args, stdout=PIPE, stderr=PIPE):
+        if args[0] == "VBoxManage" and len(args) > 1 and args[1] in ["list", "showhdinfo"]:
+            return Backend.popen(self, args, stdout, stderr)
+        return self.fallback.popen(args, stdout, stderr)
+
+    def __enumname(self, enumtype, value):
+        "Return the lower case name of value in the API enum enumtype."
+        for name, enumvalue in self.manager.constants.all_values(enumtype).items():
+            if enumvalue == value:
+                return name.lower()
+        return str(value)
+
+    def _list_vms(self):
+        lines = []
+        for machine in self.manager.getArray(self.vbox, 'machines'):
+            lines.append('"%s" {%s}' % (machine.name, machine.id))
+        return "\n".join(lines) + "\n"
+
+    def __mediumlines(self, medium):
+        "Return the `VBoxManage list hdds` lines for medium."
+        parent = medium.parent
+        lines = ["UUID:           %s" % medium.id,
+                "Parent UUID:    %s" % (parent.id if parent else "base"),
+                "Format:         %s" % medium.format,
+                "Location:       %s" % medium.location,
+                "State:          %s" % self.__enumname("MediumState", medium.state),
+                "Type:           %s" % self.__enumname("MediumType", medium.type)]
+
+        machineids = self.manager.getArray(medium, 'machineIds')
+        if machineids:
+            machineid = machineids[0]
+            machine = self.vbox.findMachine(machineid)
+            usage = "%s (UUID: %s)" % (machine.name, machineid)
+            snapshotids = [i for i in medium.getSnapshotIds(machineid) if i != machineid]
+            if snapshotids and machineid not in medium.getSnapshotIds(machineid):
+                snapshot = machine.findSnapshot(snapshotids[0])
+                usage += " [%s (UUID: %s)]" % (snapshot.name, snapshot.id)
+            lines.append("Usage:          %s" % usage)
+        return lines
+
+    def _list_hdds(self):
+        blocks = []
+        media = list(self.manager.getArray(self.vbox, 'hardDisks'))
+        # hardDisks only has the base disks, so walk down to the children
+        i = 0
+        while i < len(media):
+            medium = media[i]
+            blocks.append("\n".join(self.__mediumlines(medium)))
+            media.extend(self.manager.getArray(medium, 'children'))
+            i += 1
+        return "\n\n".join(blocks) + "\n\n"
+
+    def __listimages(self, media):
+        blocks = []
+        for medium in media:
+            blocks.append("UUID:           %s\nState:          %s\nLocation:       %s\n"
+                    "Capacity:       %d MBytes" % (medium.id,
+                        self.__enumname("MediumState", medium.state), medium.location,
+                        medium.size // (1024 * 1024)))
+        return "\n\n".join(blocks) + "\n\n"
+
+    def _list_dvds(self):
+        return self.__listimages(self.manager.getArray(self.vbox, 'DVDImages'))
+
+    def _list_floppies(self):
+        return self.__listimages(self.manager.getArray(self.vbox, 'floppyImages'))
+
+    def __listhostdrives(self, drives):
+        blocks = []
+        for drive in drives:
+            blocks.append("UUID:         %s\nName:         %s" % (drive.id, drive.name))
+        return "\n\n".join(blocks) + "\n\n"
+
+    def _list_hostdvds(self):
+        return self.__listhostdrives(self.manager.getArray(self.vbox.host, 'DVDDrives'))
+
+    def _list_hostfloppies(self):
+        return self.__listhostdrives(self.manager.getArray(self.vbox.host, 'floppyDrives'))
+
+    def _showhdinfo(self, disk):
+        try:
+            medium = self.vbox.openMedium(disk, self.manager.constants.DeviceType_HardDisk,
+                    self.manager.constants.AccessMode_ReadOnly, False)
+        except Exception as e:
+            return "", "VBoxManage: error: %s\n" % e
+        lines = self.__mediumlines(medium)
+        lines = [line.replace("Usage:         ", "In use by VMs:") for line in lines]
+        lines.append("Capacity:       %d MBytes" % (medium.logicalSize // (1024 * 1024)))
+        return "\n".join(lines) + "\n", ""
+
+# the backend used by runcommand() and friends
+currentbackend = SubprocessBackend()
+
+def getbackend():
+    "Return the backend that commands are run with."
+    return currentbackend
+
+def setbackend(backend):
+    "Run all commands with backend from now on."
+    global currentbackend
+    currentbackend = backend
+
+def selectbackend(name):
+    """
+    Run all commands with the backend called name, "subprocess" or
+    "api".  If name is None, the VBOX_CLONE_VM_BACKEND environment
+    variable is used, or "subprocess" if it isn't set.  If the API
+    bindings aren't available or don't work, fall back to the subprocess
+    backend.  The warnings about falling back go to stderr, so they don't
+    get mixed up with what is listed.
+    """
+    if name is None:
+        name = os.environ.get("VBOX_CLONE_VM_BACKEND", "subprocess")
+
+    if name == "api":
+        try:
+            setbackend(APIBackend())
+            return
+        except ImportError:
+            print("WARNING: The VirtualBox Python API is not available, using VBoxManage.",
+                    file=sys.stderr)
+        except Exception as e:
+            # the bindings raise all sorts of things when they can't
+            # get to VBoxSVC or don't match its version
+            print("WARNING: Could not use the VirtualBox Python API (%s: %s), using VBoxManage." %
+                    (type(e).__name__, e), file=sys.stderr)
+    elif name != "subprocess":
+        print("WARNING: Unknown backend \"%s\", using VBoxManage." % name, file=sys.stderr)
+
+    setbackend(SubprocessBackend())
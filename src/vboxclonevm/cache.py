@@ -0,0 +1,360 @@
+"""
+Module that keeps a persistent cache of the VirtualBox inventory (the list
+of VMs and the forest of hdds) so read-only commands don't have to run
+VBoxManage every time.  Provides the Inventory class, which loads each
+part of the inventory only when it is needed.
+
+The cache is only used if VirtualBox.xml and the settings files of all the
+registered VMs have the same modification times as when the cache was
+written.  VirtualBox changes these files whenever VMs or media are added,
+removed or changed.
+"""
+
+import contextlib
+import fnmatch
+import json
+import os
+import re
+import tempfile
+import threading
+
+from vboxclonevm.hdd import HDD, Forest, createHDDForest
+from vboxclonevm.timing import phase
+from vboxclonevm.utils import *
+from vboxclonevm.vm import VM, getVM
+from vboxclonevm.vminfo import invalidatevminfo, vminfocache
+from vboxclonevm.xmlinventory import readinventory
+
+# bump this whenever the format of the cache file changes
+CACHE_VERSION = 2
+
+machineentryre = re.compile(r'<MachineEntry\b[^>]*\bsrc="([^"]*)"')
+
+def vboxuserhome():
+    "Return the directory VirtualBox keeps VirtualBox.xml in."
+    if os.environ.get("VBOX_USER_HOME"):
+        return os.environ["VBOX_USER_HOME"]
+    for path in ["~/.config/VirtualBox", "~/.VirtualBox"]:
+        path = os.path.expanduser(path)
+        if os.path.isfile(os.path.join(path, "VirtualBox.xml")):
+            return path
+    return os.path.expanduser("~/.VirtualBox")
+
+def mtime(path):
+    "Return the modification time of path, or None if it doesn't exist."
+    try:
+        return os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+def vboxxmlpath():
+    "Return the path of VirtualBox.xml."
+    return os.path.join(vboxuserhome(), "VirtualBox.xml")
+
+def watchedfiles():
+    """
+    Return a dict mapping VirtualBox.xml and the settings file of every
+    registered vm to their modification times.
+    """
+    home = vboxuserhome()
+    vboxxml = vboxxmlpath()
+    files = {vboxxml: mtime(vboxxml)}
+    try:
+        with open(vboxxml) as f:
+            contents = f.read()
+    except (IOError, OSError):
+        return files
+
+    for src in machineentryre.findall(contents):
+        path = os.path.join(home, src)
+        files[path] = mtime(path)
+    return files
+
+class InventoryCache:
+    """
+    The vms and hdds read from the cache file at filename.  The vms and
+    the hdds are kept in separate sections of the file, each with the
+    modification times they were read at, so one can be updated without
+    having to read the other.
+    """
+    def __init__(self, filename=None):
+        if filename is None:
+            filename = os.path.join(cachedir(), "inventory.json")
+        self.filename = filename
+
+    def __read(self):
+        "Return the whole contents of the cache file, or an empty cache."
+        try:
+            with open(self.filename) as f:
+                cache = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {"version": CACHE_VERSION}
+
+        if cache.get("version") != CACHE_VERSION:
+            return {"version": CACHE_VERSION}
+        return cache
+
+    def load(self, section):
+        """
+        Return the cached items of section ("vms" or "hdds"), or None if
+        they aren't cached or are stale.
+        """
+        cached = self.__read().get(section)
+        if not cached:
+            return None
+        for path, cachedmtime in cached["files"].items():
+            if mtime(path) != cachedmtime:
+                return None
+        return cached["items"]
+
+    def save(self, section, files, items):
+        """
+        Write items to section of the cache.  files is the dict from
+        watchedfiles() from before the items were read.
+        """
+        if all(m is None for m in files.values()):
+            # there is nothing to tell us when the cache becomes stale
+            return
+
+        cache = self.__read()
+        cache[section] = {"files": files, "items": items}
+
+        directory = os.path.dirname(self.filename)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(dir=directory, prefix=".inventory")
+            with os.fdopen(fd, "w") as f:
+                json.dump(cache, f)
+            os.replace(tmpname, self.filename)
+        except (IOError, OSError) as e:
+            # not being able to write the cache just makes the next run slower
+            print("WARNING: Could not write cache %s: %s" % (self.filename, e))
+
+class Inventory:
+    """
+    The Forest of all hdds and the list of all vms, each only read when it
+    is first needed and then reused.  If usecache is True, they are read
+    from the cache if it is still valid, otherwise they are read from
+    VBoxManage and the cache is updated.
+
+    If source is "xml", VirtualBox's settings files are read directly
+    instead, both at once, and the cache isn't used since reading them
+    is about as fast.
+    """
+    def __init__(self, usecache=True, source="vboxmanage"):
+        self.usecache = usecache
+        self.source = source
+        self.cache = InventoryCache()
+        self.__forest = None
+        self.__vms = None
+        # the watchedfiles() from before each part was read
+        self.__files = {}
+        # the (paths, vm name patterns) of the changes being made through
+        # this inventory, see changing()
+        self.__changing = []
+        self.lock = threading.RLock()
+
+    @property
+    def forest(self):
+        "The Forest of all hdds."
+        if self.__forest is None:
+            with phase("inventory"):
+                self.__loadforest()
+        if "hdd" not in mediacatalog.loaded:
+            mediacatalog.addhdds(self.__forest.values())
+        return self.__forest
+
+    def __loadforest(self):
+        "Read the forest from the cache or VBoxManage."
+        files = watchedfiles()
+        if self.source == "xml":
+            self.__loadxml(files)
+            return
+        self.__files["hdds"] = files
+        hdds = None
+        if self.usecache:
+            hdds = self.cache.load("hdds")
+        if hdds is not None:
+            self.__forest = Forest()
+            for lines in hdds:
+                hdd = HDD(lines, self.__forest)
+                self.__forest[hdd.uuid] = hdd
+        else:
+            # the modification times are from before reading from
+            # VBoxManage, so that anything that changes while we are
+            # reading makes the cache stale
+            self.__forest = createHDDForest()
+            self.cache.save("hdds", files,
+                    [hdd.lines() for hdd in self.__forest.values()])
+
+        # vms that were already read don't know about the forest yet
+        for vm in self.__vms or []:
+            vm.hddforest = self.__forest
+
+    @property
+    def vms(self):
+        "The list of all vms."
+        if self.__vms is None:
+            with phase("inventory"):
+                self.__loadvms()
+        return self.__vms
+
+    def __loadvms(self):
+        "Read the vms from the cache or VBoxManage."
+        files = watchedfiles()
+        if self.source == "xml":
+            self.__loadxml(files)
+            return
+        self.__files["vms"] = files
+        vms = None
+        if self.usecache:
+            vms = self.cache.load("vms")
+        if vms is not None:
+            self.__vms = [VM('"%s" {%s}' % (name, uuid), self.__forest)
+                    for name, uuid in vms]
+        else:
+            self.__vms = getVM(self.__forest)
+            self.cache.save("vms", files, [(vm.name, vm.uuid) for vm in self.__vms])
+
+    def __loadxml(self, files):
+        """
+        Read both the vms and the forest from VirtualBox's settings files.
+        files is the watchedfiles() from before reading them.
+        """
+        vms, forest = readinventory(vboxuserhome())
+        if self.__forest is None:
+            self.__forest = forest
+            self.__files["hdds"] = files
+        for vm in vms:
+            vm.hddforest = self.__forest
+        if self.__vms is None:
+            self.__vms = vms
+            self.__files["vms"] = files
+
+    def refresh(self):
+        """
+        Forget the parts of the inventory that VirtualBox has changed since
+        they were read, so they are read again when they are next needed,
+        the cached VMInfo of the vms whose settings files changed, and the
+        media catalog if anything changed, since media may have been added.
+        Changes being made through this inventory, see changing(), don't
+        count.  Nothing is read if nothing has changed.  Return True if
+        anything was forgotten.
+        """
+        with self.lock:
+            files = watchedfiles()
+            changed = False
+            if self.__forest is not None and self.__differs("hdds", files):
+                self.__forest = None
+                changed = True
+            if self.__vms is not None and self.__differs("vms", files):
+                self.__vms = None
+                changed = True
+
+            before = self.__files.get("vminfo", {})
+            for vmuuid, info in list(vminfocache.items()):
+                cfgfile = info.cfgfile()
+                if files.get(cfgfile) is None or files.get(cfgfile) != before.get(cfgfile):
+                    invalidatevminfo(vmuuid)
+            self.__files["vminfo"] = files
+
+            if self.__differs("media", files):
+                mediacatalog.invalidate()
+                self.__files["media"] = files
+            return changed
+
+    def __ischanging(self, path):
+        "Return True if path is being changed through this inventory."
+        filename = os.path.basename(path)
+        for paths, vmnames in self.__changing:
+            if path in paths:
+                return True
+            for vmname in vmnames:
+                if fnmatch.fnmatchcase(filename, vmname + ".vbox"):
+                    return True
+        return False
+
+    def __differs(self, section, files):
+        """
+        Return True if files, from watchedfiles(), differ from the ones
+        section was read with, apart from the files being changed through
+        this inventory.
+        """
+        before = self.__files.get(section)
+        if before is None:
+            return True
+        for path in set(before) | set(files):
+            if before.get(path) != files.get(path) and not self.__ischanging(path):
+                return True
+        return False
+
+    @contextlib.contextmanager
+    def changing(self, paths=(), vmnames=()):
+        """
+        Say that the files at paths, and the settings files of the vms
+        with names matching the patterns in vmnames (as for fnmatch), are
+        about to be changed through this inventory, which is kept up to
+        date as they are (by addvm(), removevm() and adding hdds to the
+        forest and the media catalog).  refresh() doesn't forget anything because of
+        these changes, while they are being made or afterwards, but
+        changes to any other files are still noticed.  Changes that
+        VirtualBox makes to the same files meanwhile for other reasons are
+        missed.
+        """
+        changes = (set(paths), set(vmnames))
+        with self.lock:
+            self.__changing.append(changes)
+        try:
+            yield
+        finally:
+            with self.lock:
+                # the inventory is up to date with these files as they
+                # are now, and still as old as before with the others
+                files = watchedfiles()
+                for section in ["hdds", "vms", "media"]:
+                    if self.__files.get(section) is None:
+                        continue
+                    # the sections may share one dict, so don't change it
+                    before = dict(self.__files[section])
+                    for path in set(before) | set(files):
+                        if self.__ischanging(path):
+                            if path in files:
+                                before[path] = files[path]
+                            else:
+                                before.pop(path, None)
+                    self.__files[section] = before
+                self.__changing.remove(changes)
+
+    def findvms(self, vmname):
+        "Return a list of the vms with the name or uuid vmname."
+        return [vm for vm in self.vms if vm.name == vmname or vm.uuid == vmname]
+
+    def addvm(self, vm):
+        """
+        Add vm, a vm that was just created, to the list of vms.  If the
+        list has a vm with the same uuid (because it was renamed), vm
+        takes its place.
+        """
+        with self.lock:
+            if self.__vms is None:
+                return
+            for i, other in enumerate(self.__vms):
+                if other.uuid == vm.uuid:
+                    self.__vms[i] = vm
+                    return
+            self.__vms.append(vm)
+
+    def removevm(self, uuid):
+        """
+        Remove the vm with uuid, which was just deleted with its hard
+        disks (by `VBoxManage unregistervm --delete`), from the list of
+        vms, and its hdds from the forest and the media catalog.
+        """
+        with self.lock:
+            if self.__vms is not None:
+                self.__vms[:] = [vm for vm in self.__vms if vm.uuid != uuid]
+            if self.__forest is not None:
+                for hdd in hddsattachedto(uuid, self.__forest):
+                    del self.__forest[hdd.uuid]
+            invalidatevminfo(uuid)
+            mediacatalog.invalidate("hdd")
@@ -0,0 +1,355 @@
+"""
+Module for running vbox-clone-vm as a daemon that keeps the inventory in
+memory between requests, and takes clone and list requests from clients
+on a Unix socket.  Provides the Daemon class, and request() for the
+client side.
+
+A request is one line of JSON with a "command" ("clone" or one of the
+LISTCOMMANDS of the listing module) and its arguments.  The daemon answers
+with lines of JSON: {"output": TEXT} for everything the request prints,
+as it is printed, and finally {"exit": STATUS}.
+
+Clone requests wait in a queue of at most queuesize requests, and at most
+jobs of them run at the same time, each copying at most jobs hard disks
+at a time.  Refilling a WarmPool after a clone is taken from it is queued
+like a clone.  Clones of the same vm are run one after the other, since
+they would all need its session lock, and the hard disk copies of all
+the clones share one limit per filesystem.
+"""
+
+import contextvars
+import glob
+import json
+import os
+import queue
+import socket
+import socketserver
+import sys
+import threading
+import traceback
+
+from vboxclonevm.cache import Inventory, vboxxmlpath
+from vboxclonevm.journal import Journal
+from vboxclonevm.listing import LISTCOMMANDS, listinventory
+from vboxclonevm.pools import StoragePools
+from vboxclonevm.utils import *
+from vboxclonevm.vm import cloneVMs
+from vboxclonevm.warmpool import WarmPool
+
+# how many clone requests may wait for their turn
+QUEUE_SIZE = 16
+
+# where what the current request prints goes, or None for stdout
+requestoutput = contextvars.ContextVar("requestoutput", default=None)
+
+def socketpath():
+    "Return the path of the daemon's socket if none is given."
+    return os.path.join(cachedir(), "daemon.sock")
+
+class RequestOutput:
+    """
+    Sends what a request prints to its client.  If the client has gone
+    away the request carries on, and what it prints is dropped.
+    """
+    def __init__(self, wfile):
+        self.wfile = wfile
+        self.lock = threading.Lock()
+
+    def send(self, **message):
+        "Send message, a dict, to the client."
+        with self.lock:
+            try:
+                self.wfile.write((json.dumps(message) + "\n").encode('utf-8'))
+                self.wfile.flush()
+            except (IOError, OSError):
+                pass
+
+    def write(self, text):
+        if text:
+            self.send(output=text)
+        return len(text)
+
+    def flush(self):
+        pass
+
+class OutputSwitch:
+    """
+    Stands in for sys.stdout in the daemon, and sends what is printed to
+    the client of the request that printed it, or to stdout.
+    """
+    def __init__(self, stdout):
+        self.stdout = stdout
+
+    def write(self, text):
+        output = requestoutput.get()
+        if output is None:
+            return self.stdout.write(text)
+        return output.write(text)
+
+    def flush(self):
+        output = requestoutput.get()
+        if output is None:
+            self.stdout.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stdout, name)
+
+class Daemon:
+    """
+    Serves requests on the Unix socket at path.  The vms and the Forest
+    are read once, with source as for Inventory, and only read again once
+    VirtualBox has changed them.  At most jobs clone requests are run at
+    the same time, at most queuesize wait for their turn, and at most
+    jobsperfs hard disks are copied to the same filesystem at the same
+    time by all of them together.
+    """
+    def __init__(self, path=None, jobs=1, jobsperfs=None, queuesize=QUEUE_SIZE,
+            source="vboxmanage"):
+        if path is None:
+            path = socketpath()
+        self.path = path
+        self.jobs = jobs
+        self.groupjobs = None
+        if jobsperfs is not None:
+            self.groupjobs = GroupLimit(jobsperfs)
+        self.queue = queue.Queue(queuesize)
+        self.inventory = Inventory(True, source)
+        # held while the inventory is refreshed or looked at; it is the
+        # inventory's own lock, so the clones (and a WarmPool's taking and
+        # deleting of pooled clones) hold it while they change it
+        self.lock = self.inventory.lock
+        # held by the clones of each vm, keyed by vm uuid
+        self.vmlocks = {}
+
+    def serve(self):
+        "Serve requests until interrupted."
+        if os.path.exists(self.path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                try:
+                    s.connect(self.path)
+                except OSError:
+                    # left over from a daemon that didn't stop cleanly
+                    os.unlink(self.path)
+                else:
+                    print("ERROR! A daemon is already listening on %s." % self.path)
+                    sys.exit(1)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+
+        daemon = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                daemon.handle(self.rfile.readline(), RequestOutput(self.wfile))
+
+        # anyone who can connect can make and rename our vms, so the
+        # socket is only ever accessible to us
+        umask = os.umask(0o077)
+        try:
+            server = socketserver.ThreadingUnixStreamServer(self.path, Handler)
+        finally:
+            os.umask(umask)
+        server.daemon_threads = True
+
+        for i in range(max(1, self.jobs)):
+            threading.Thread(target=self.__work, name="clone worker %d" % i,
+                    daemon=True).start()
+
+        sys.stdout = OutputSwitch(sys.stdout)
+        print("Listening on %s." % self.path)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            os.unlink(self.path)
+
+    def handle(self, line, output):
+        "Answer the request in line, sending what it prints to output, a RequestOutput."
+        try:
+            message = json.loads(line.decode('utf-8'))
+            command = message.pop("command")
+        except (ValueError, KeyError, AttributeError):
+            output.send(output="ERROR! Could not understand the request.\n", exit=1)
+            return
+
+        if command == "clone":
+            job = self.__enqueue(output, self.clone, message)
+            if job is None:
+                output.send(output="ERROR! %d clones are already waiting, try again later.\n" %
+                        self.queue.maxsize, exit=1)
+                return
+            job["done"].wait()
+            status = job["status"]
+        elif command in LISTCOMMANDS:
+            status = self.__run(output, self.listinventory, command, **message)
+        else:
+            output.send(output="ERROR! Unknown command %s.\n" % command, exit=1)
+            return
+        output.send(exit=status)
+
+    def __enqueue(self, output, function, kwargs):
+        """
+        Queue a job that calls function with kwargs, with what it prints
+        going to output (or stdout if output is None).  Return the job,
+        or None if the queue is full.
+        """
+        job = {"function": function, "kwargs": kwargs, "output": output,
+                "done": threading.Event()}
+        try:
+            self.queue.put_nowait(job)
+        except queue.Full:
+            return None
+        return job
+
+    def __work(self):
+        "Run jobs from the queue, forever."
+        while True:
+            job = self.queue.get()
+            job["status"] = self.__run(job["output"], job["function"], **job["kwargs"])
+            job["done"].set()
+
+    def __run(self, output, function, *args, **kwargs):
+        """
+        Call function with what it prints going to output, and return the
+        exit status it would have had as a command of its own.
+        """
+        def run():
+            requestoutput.set(output)
+            try:
+                function(*args, **kwargs)
+            except SystemExit as e:
+                if e.code is None or isinstance(e.code, int):
+                    return e.code or 0
+                print(e.code)
+                return 1
+            except Exception:
+                print("ERROR! %s" % traceback.format_exc().rstrip("\n"))
+                return 1
+            return 0
+        return contextvars.copy_context().run(run)
+
+    def __findvm(self, vmname):
+        "Return the vm called vmname.  self.lock must be held."
+        vms = self.inventory.findvms(vmname)
+        if not vms:
+            print("ERROR! No vms with name \"%s\"." % vmname)
+            sys.exit(1)
+        if len(vms) > 1:
+            print("ERROR! Multiple vms with name \"%s\"." % vmname)
+            sys.exit(1)
+        return vms[0]
+
+    def listinventory(self, command, disk=None, asjson=False):
+        "Print what command lists, see listing.listinventory()."
+        with self.lock:
+            self.inventory.refresh()
+            listinventory(self.inventory, command, disk, asjson)
+
+    def __vmlock(self, vm):
+        "Return the vm called vm and the lock its clones hold."
+        with self.lock:
+            self.inventory.refresh()
+            fromvm = self.__findvm(vm)
+            return fromvm, self.vmlocks.setdefault(fromvm.uuid, threading.Lock())
+
+    def clone(self, vm, names, jobs=1, linked=False, fastcopy=False, pools=None,
+            frompool=False):
+        """
+        Clone the vm called vm to a new vm for each name in names, as
+        vbox-clone-vm does, copying at most jobs hard disks, and no more
+        than the daemon's jobs, at the same time.  pools is a list of
+        storage pool directories.  If frompool is True, a clone is taken
+        from the vm's WarmPool if there is one ready, and the pool is
+        refilled afterwards.
+        """
+        jobs = max(1, min(jobs, self.jobs))
+        fromvm, vmlock = self.__vmlock(vm)
+        with vmlock:
+            # the clones before this one may have changed things
+            with self.lock:
+                self.inventory.refresh()
+                existing = [other.name for other in self.inventory.vms]
+                hddforest = self.inventory.forest
+
+            for name in names:
+                # a clone that was interrupted is carried on with
+                if Journal.forclone(fromvm.uuid, name).get("create") is not None:
+                    continue
+                if name in existing:
+                    print("ERROR! VM \"%s\" already exists." % name)
+                    sys.exit(1)
+
+            # what the clones change is added to the inventory as they go,
+            # so it doesn't have to be read again afterwards
+            vmnames = [glob.escape(name) for name in names]
+            if frompool:
+                vmnames.append(glob.escape(fromvm.name) + "-pool-*")
+            fromvm.fillininfo()
+            with self.inventory.changing([vboxxmlpath(), fromvm.cfgfile()], vmnames):
+                newvms = self.__clone(fromvm, names, hddforest, jobs, linked, fastcopy,
+                        pools, frompool)
+                with self.lock:
+                    for newvm in newvms:
+                        self.inventory.addvm(newvm)
+        for newvm in newvms:
+            print("Created new vm: %s" % newvm)
+
+        if frompool and len(names) == 1:
+            # the refill waits its turn like any other clone
+            if self.__enqueue(None, self.refill, {"vm": fromvm.uuid, "jobs": jobs}) is None:
+                print("WARNING: Too many clones are waiting to refill the pool of %s now." %
+                        fromvm.name)
+
+    def refill(self, vm, jobs=1):
+        "Fill the WarmPool of the vm called vm back up."
+        fromvm, vmlock = self.__vmlock(vm)
+        with vmlock:
+            with self.lock:
+                self.inventory.refresh()
+            fromvm.fillininfo()
+            with self.inventory.changing([vboxxmlpath(), fromvm.cfgfile()],
+                    [glob.escape(fromvm.name) + "-pool-*"]):
+                WarmPool(self.inventory, fromvm).refill(jobs, self.groupjobs)
+
+    def __clone(self, fromvm, names, hddforest, jobs, linked, fastcopy, pools, frompool):
+        "Make the clones for clone(), and return the new vms."
+        if frompool and len(names) == 1:
+            warmpool = WarmPool(self.inventory, fromvm)
+            newvm = warmpool.take(names[0])
+            if newvm is not None:
+                return [newvm]
+            print("WARNING: No clones of %s ready in the pool, cloning it." % fromvm.name)
+
+        storagepools = None
+        if pools:
+            storagepools = StoragePools(pools)
+        return cloneVMs(fromvm, names, hddforest, jobs, self.groupjobs, linked,
+                fastcopy=fastcopy, pools=storagepools)
+
+def request(message, path=None):
+    """
+    Send message, a dict with the command and its arguments, to the
+    daemon listening at path, print what it sends back and return the
+    exit status of the request.
+    """
+    if path is None:
+        path = socketpath()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+        try:
+            s.connect(path)
+        except OSError as e:
+            print("ERROR! Could not connect to the daemon at %s: %s" % (path, e))
+            sys.exit(1)
+        s.sendall((json.dumps(message) + "\n").encode('utf-8'))
+
+        with s.makefile("rb") as f:
+            for line in f:
+                answer = json.loads(line.decode('utf-8'))
+                if "output" in answer:
+                    sys.stdout.write(answer["output"])
+                    sys.stdout.flush()
+                if "exit" in answer:
+                    return answer["exit"]
+
+    print("ERROR! The daemon stopped before the request was done.")
+    return 1
@@ -0,0 +1,86 @@
+"""
+Module for copying disk image files without reading them into userspace.
+On filesystems with reflinks (btrfs, XFS) the copy shares the original's
+blocks and is almost instant; elsewhere copy_file_range() lets the kernel
+do the copying.  If neither works, the caller should fall back to
+`VBoxManage clonehd`.
+"""
+
+import errno
+import fcntl
+import os
+
+# the FICLONE ioctl from linux/fs.h
+FICLONE = 0x40049409
+
+# how much copy_file_range() copies at a time, so progress can be reported
+CHUNKSIZE = 64 * 1024 * 1024
+
+# errors that mean the filesystem or kernel can't do it, not that the copy failed
+UNSUPPORTED = set([errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTTY, errno.EXDEV,
+    errno.EINVAL, errno.EBADF])
+
+def reflink(sourcefd, targetfd):
+    "Make targetfd share sourcefd's blocks.  Return False if that isn't supported."
+    try:
+        fcntl.ioctl(targetfd, FICLONE, sourcefd)
+    except OSError as e:
+        if e.errno in UNSUPPORTED:
+            return False
+        raise
+    return True
+
+def copyfilerange(sourcefd, targetfd, size, onprogress=None):
+    """
+    Copy size bytes from sourcefd to targetfd with copy_file_range(),
+    calling onprogress with the percentage copied after each chunk.
+    Return False if copy_file_range() isn't supported.
+    """
+    if not hasattr(os, "copy_file_range"):
+        return False
+    copied = 0
+    while copied < size:
+        try:
+            n = os.copy_file_range(sourcefd, targetfd, min(CHUNKSIZE, size - copied))
+        except OSError as e:
+            if e.errno in UNSUPPORTED and copied == 0:
+                return False
+            raise
+        if n == 0:
+            raise OSError(errno.EIO, "Unexpected end of file after %d of %d bytes" % (copied, size))
+        copied += n
+        if onprogress:
+            onprogress(copied * 100 // size)
+    return True
+
+def copyimage(source, target, onprogress=None):
+    """
+    Copy the file source to the new file target with the fastest way the
+    kernel has.  Return "reflink" or "copy_file_range" for the way that
+    was used, or None if neither is supported, in which case target isn't
+    left behind.  Raises OSError if the copy fails for another reason,
+    also without leaving target behind.
+    """
+    sourcefd = os.open(source, os.O_RDONLY)
+    try:
+        targetfd = os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    except OSError:
+        os.close(sourcefd)
+        raise
+
+    method = None
+    try:
+        if reflink(sourcefd, targetfd):
+            method = "reflink"
+            if onprogress:
+                onprogress(100)
+        elif copyfilerange(sourcefd, targetfd, os.fstat(sourcefd).st_size, onprogress):
+            method = "copy_file_range"
+        if method:
+            os.fsync(targetfd)
+    finally:
+        os.close(sourcefd)
+        os.close(targetfd)
+        if method is None:
+            os.unlink(target)
+    return method
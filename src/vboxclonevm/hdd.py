@@ -1,12 +1,13 @@
 
 """
-Module that deals with VirtualBox hard disks.  Provides both HDD class and
-Forest class.
+Module that deals with VirtualBox hard disks.  Provides the HDD class,
+the Forest class and the SubtreeSummary class.
 """
 
 import os
 import re
 import sys
+import threading
 
 from vboxclonevm.utils import *
 
@@ -14,32 +15,55 @@ class HDD:
     """
     Create a vdi entry from the output of `VBoxManage list hdds`.
     """
+    __slots__ = ("uuid", "parentuuid", "hdformat", "hdlocation", "hdstate",
+            "hdtype", "hdusage", "hdvm", "hdvmuuid", "hdsnapshot",
+            "hdsnapshotuuid", "forest", "parent")
+
+    # maps the keys in the output of VBoxManage to the HDD attributes
+    fieldnames = {
+            "UUID": "uuid",
+            "Parent UUID": "parentuuid",
+            "Format": "hdformat",
+            "Storage format": "hdformat",
+            "Location": "hdlocation",
+            "State": "hdstate",
+            "Type": "hdtype",
+            "Usage": "hdusage",
+            "In use by VMs": "hdusage",
+            }
+
+    usagere = re.compile(r'^(.*?) \(UUID: ([\w\d-]+)\)$')
+    snapshotusagere = re.compile(r'^(.*?) \(UUID: ([\w\d-]+)\) \[(.*?) \(UUID: ([\w\d-]+)\)\]$')
+
     def __init__(self, lines, forest=None, parent=None):
         """
-        Initialize an hdd.  lines is a list of the 7 lines of output
-        from `VBoxManage list hdds`.  forest is a Forest object or None.
-        parent is the parent HDD object or None.
+        Initialize an hdd.  lines is a list of the lines of output for
+        one hdd from `VBoxManage list hdds` (or `VBoxManage showhdinfo`).
+        forest is a Forest object or None.  parent is the parent HDD
+        object or None.
         """
-        assert(len(lines) >= 6)
-
-        self.uuid = re.sub(r'^UUID:\W+', '', lines[0])
-        self.parentuuid = re.sub(r'^Parent UUID:\W+', '', lines[1])
-        self.hdformat = re.sub(r'^Format:\W+', '', lines[2])
-        self.hdlocation = re.sub(r'^Location:\s+', '', lines[3])
-        self.hdstate = re.sub(r'^State:\W+', '', lines[4])
-        self.hdtype = re.sub(r'^Type:\W+', '', lines[5])
-
+        self.uuid = None
+        self.parentuuid = "base"
+        self.hdformat = None
+        self.hdlocation = None
+        self.hdstate = None
+        self.hdtype = None
         self.hdusage = None
+        for line in lines:
+            key, sep, value = line.partition(":")
+            attribute = self.fieldnames.get(key)
+            if sep and attribute and value.strip():
+                setattr(self, attribute, value.strip())
+        assert(self.uuid)
+
         self.hdvm = None
         self.hdvmuuid = None
         self.hdsnapshot = None
         self.hdsnapshotuuid = None
-        if len(lines) == 7:
-            self.hdusage = re.sub(r'^Usage:\W+', '', lines[6])
-
-            m = re.match(r'^(.*?) \(UUID: ([\w\d-]+)\)$', self.hdusage)
+        if self.hdusage:
+            m = self.usagere.match(self.hdusage)
             if not m:
-                m = re.match(r'^(.*?) \(UUID: ([\w\d-]+)\) \[(.*?) \(UUID: ([\w\d-]+)\)\]$', self.hdusage)
+                m = self.snapshotusagere.match(self.hdusage)
                 if not m:
                     print("Couldn't get usage information for hd %s: %s" % (self.uuid, self.hdusage))
                     sys.exit(1)
@@ -54,6 +78,23 @@ class HDD:
         self.forest = forest
         self.parent = parent
 
+    def lines(self):
+        """
+        Return this hdd as a list of lines in the same format as
+        `VBoxManage list hdds`, so HDD(hdd.lines()) makes the same hdd.
+        """
+        lines = ["UUID: %s" % self.uuid, "Parent UUID: %s" % self.parentuuid]
+        for key, value in [("Format", self.hdformat), ("Location", self.hdlocation),
+                ("State", self.hdstate), ("Type", self.hdtype)]:
+            if value is not None:
+                lines.append("%s: %s" % (key, value))
+        if self.hdvm:
+            usage = "%s (UUID: %s)" % (self.hdvm, self.hdvmuuid)
+            if self.hdsnapshot:
+                usage += " [%s (UUID: %s)]" % (self.hdsnapshot, self.hdsnapshotuuid)
+            lines.append("Usage: %s" % usage)
+        return lines
+
     def __str__(self):
         string = ""
         string += "uuid: %s\n" % self.uuid
@@ -77,26 +118,155 @@ class HDD:
     def __repr__(self):
         return self.__str__()
 
+class SubtreeSummary:
+    """
+    What a node and all of its descendants add up to.  size is the bytes
+    their files take on disk, leaving out the unknown files that couldn't
+    be read, nodes is how many there are, depth is the number of nodes on
+    the longest chain down from the node, and used is how many of them
+    are used by a vm.
+    """
+    def __init__(self, size=0, nodes=0, depth=0, used=0, unknown=0):
+        self.size = size
+        self.nodes = nodes
+        self.depth = depth
+        self.used = used
+        self.unknown = unknown
+
+    def __str__(self):
+        return "SubtreeSummary(size: %s, nodes: %s, depth: %s, used: %s, unknown: %s)" % (
+                self.size, self.nodes, self.depth, self.used, self.unknown)
+
+    def __repr__(self):
+        return self.__str__()
+
 class Forest:
     """
     Forest of multiple trees of unique nodes.
-    Each node needs to have a uuid and parent member."""
+    Each node needs to have a uuid and parent member.
+
+    The forest keeps indexes of children by parent uuid, of the nodes
+    that have no children, of the nodes whose parent isn't in the forest,
+    of nodes by location and of nodes by the vm they are used by, so none
+    of the lookups have to scan every node.  Nodes can be added and
+    removed from several threads at once.
+
+    The sizes of the nodes' files are only read when they are asked for,
+    and the SubtreeSummary of each subtree is kept until a node in it is
+    added, removed or changes size.
+    """
 
     def __init__(self):
+        self.lock = threading.RLock()
         self.nodes = {}
 
+        # these all map to dicts used as insertion-ordered sets of uuids
+        self.children = {}
+        self.ends = {}
+        self.roots = {}
+        self.byvm = {}
+
+        self.bylocation = {}
+
+        # bytes each node's file takes on disk, or None if it can't be read
+        self.sizes = {}
+        # the SubtreeSummary of each node's subtree.  If a node's summary
+        # is here, so are the summaries of all of its descendants.
+        self.summaries = {}
+
     def __getitem__(self, key):
         return self.nodes[key]
 
     def __setitem__(self, key, new_node):
+        with self.lock:
+            self.__setnode(key, new_node)
+
+    def __setnode(self, key, new_node):
         assert(key == new_node.uuid)
-        for n in self.nodes.values():
-            if n.parentuuid == new_node.uuid:
-                n.parent = new_node
-            if n.uuid == new_node.parentuuid:
-                new_node.parent = n
+        if key in self.nodes:
+            self.__delnode(key)
+
         self.nodes[key] = new_node
 
+        # link to the parent if we already have it
+        parent = self.nodes.get(new_node.parentuuid)
+        if parent:
+            new_node.parent = parent
+        else:
+            self.roots[key] = None
+        self.children.setdefault(new_node.parentuuid, {})[key] = None
+        self.ends.pop(new_node.parentuuid, None)
+
+        # link to any children that were added before this node
+        children = self.children.get(key)
+        if children:
+            for child_uuid in children:
+                self.nodes[child_uuid].parent = new_node
+                self.roots.pop(child_uuid, None)
+        else:
+            self.ends[key] = None
+        self.__invalidate(key)
+
+        location = getattr(new_node, "hdlocation", None)
+        if location:
+            self.bylocation[location] = new_node
+        for vm in self.__vmkeys(new_node):
+            self.byvm.setdefault(vm, {})[key] = None
+
+    def __delitem__(self, key):
+        with self.lock:
+            self.__delnode(key)
+
+    def update(self, key, **attributes):
+        """
+        Set attributes (like hdvm) of the node with uuid key, keeping the
+        indexes up to date.  Changing a node that is in the forest any
+        other way leaves them out of date.
+        """
+        with self.lock:
+            node = self.nodes[key]
+            self.__delnode(key)
+            for name, value in attributes.items():
+                setattr(node, name, value)
+            self.__setnode(key, node)
+
+    def __delnode(self, key):
+        self.__invalidate(key)
+        self.sizes.pop(key, None)
+        node = self.nodes.pop(key)
+
+        siblings = self.children.get(node.parentuuid)
+        if siblings is not None:
+            siblings.pop(key, None)
+            if not siblings:
+                del self.children[node.parentuuid]
+                if node.parentuuid in self.nodes:
+                    self.ends[node.parentuuid] = None
+
+        for child_uuid in self.children.get(key, {}):
+            self.nodes[child_uuid].parent = None
+            self.roots[child_uuid] = None
+        self.ends.pop(key, None)
+        self.roots.pop(key, None)
+
+        location = getattr(node, "hdlocation", None)
+        if location and self.bylocation.get(location) is node:
+            del self.bylocation[location]
+        for vm in self.__vmkeys(node):
+            vmnodes = self.byvm.get(vm)
+            if vmnodes is not None:
+                vmnodes.pop(key, None)
+                if not vmnodes:
+                    del self.byvm[vm]
+
+    def __invalidate(self, key):
+        "Forget the summaries of the subtrees the node with uuid key is in."
+        self.summaries.pop(key, None)
+        node = self.nodes.get(key)
+        while node is not None and node.parentuuid in self.summaries:
+            del self.summaries[node.parentuuid]
+            node = self.nodes.get(node.parentuuid)
+
     def __contains__(self, key):
         return self.nodes.__contains__(key)
 
@@ -113,6 +283,12 @@ class Forest:
 
         return string
 
+    @staticmethod
+    def __vmkeys(node):
+        "Return the vm names and uuids a node is used by."
+        return [vm for vm in (getattr(node, "hdvm", None),
+            getattr(node, "hdvmuuid", None)) if vm]
+
     def items(self):
         return self.nodes.items()
 
@@ -121,7 +297,7 @@ class Forest:
 
     def getends(self):
         "Return a list of nodes in forest that have no children."
-        return [n for n in self.nodes.values() if not self.getChildren(n.uuid)]
+        return [self.nodes[uuid] for uuid in self.ends]
 
     def getChildren(self, parent_node_uuid):
         """
@@ -129,24 +305,171 @@ class Forest:
         just a string of the parent node's uuid.
         """
         assert(type(parent_node_uuid) != type(HDD))
-        return [n for n in self.nodes.values() if n.parentuuid == parent_node_uuid]
+        return [self.nodes[uuid] for uuid in self.children.get(parent_node_uuid, {})]
+
+    def getchain(self, node_uuid):
+        """
+        Return a list of the node with node_uuid and all of its ancestors,
+        starting with the node and ending with the root of its tree.  If
+        an ancestor is missing from the forest, the last node's parentuuid
+        is the uuid of the missing ancestor.
+        """
+        chain = [self.nodes[node_uuid]]
+        while chain[-1].parentuuid in self.nodes:
+            chain.append(self.nodes[chain[-1].parentuuid])
+        return chain
+
+    def getroots(self):
+        """
+        Return a list of the nodes whose parent isn't in the forest: the
+        base disks, and the differencing disks whose parent is missing.
+        """
+        return [self.nodes[uuid] for uuid in self.roots]
+
+    def getroot(self, node_uuid):
+        "Return the root of the tree the node with node_uuid is in."
+        return self.getchain(node_uuid)[-1]
+
+    def getsubtree(self, node_uuid):
+        """
+        Return a list of the node with node_uuid and all of its
+        descendants, each after its parent.
+        """
+        subtree = []
+        stack = [node_uuid]
+        while stack:
+            uuid = stack.pop()
+            subtree.append(self.nodes[uuid])
+            stack.extend(reversed(list(self.children.get(uuid, {}))))
+        return subtree
+
+    @staticmethod
+    def __statsize(node):
+        "Return the bytes the file of node takes on disk, or None if it can't be read."
+        try:
+            return os.stat(node.hdlocation).st_blocks * 512
+        except (AttributeError, OSError, TypeError):
+            return None
+
+    def statsizes(self, node_uuids=None, refresh=False):
+        """
+        Read the sizes of the files of the nodes with node_uuids (by
+        default all of them) that aren't known yet, or of all of them if
+        refresh is True, in one pass.  Only the summaries of the subtrees
+        whose sizes changed are forgotten.
+        """
+        if node_uuids is None:
+            node_uuids = list(self.nodes)
+        for uuid in node_uuids:
+            if not refresh and uuid in self.sizes:
+                continue
+            node = self.nodes.get(uuid)
+            if node is None:
+                continue
+            size = self.__statsize(node)
+            with self.lock:
+                if uuid not in self.nodes:
+                    continue
+                if uuid not in self.sizes or self.sizes[uuid] != size:
+                    self.sizes[uuid] = size
+                    self.__invalidate(uuid)
+
+    def getsize(self, node_uuid):
+        "Return the bytes the file of the node with node_uuid takes on disk, or None."
+        if node_uuid not in self.sizes:
+            self.statsizes([node_uuid])
+        return self.sizes.get(node_uuid)
+
+    def getsummary(self, node_uuid):
+        """
+        Return the SubtreeSummary of the node with node_uuid and all of
+        its descendants.  The sizes that aren't known yet are read.
+        """
+        with self.lock:
+            stack = [node_uuid]
+            while stack:
+                uuid = stack[-1]
+                if uuid in self.summaries:
+                    stack.pop()
+                    continue
+                children = self.children.get(uuid, {})
+                pending = [child for child in children if child not in self.summaries]
+                if pending:
+                    stack.extend(pending)
+                    continue
+                stack.pop()
+
+                node = self.nodes[uuid]
+                size = self.getsize(uuid)
+                summary = SubtreeSummary(size or 0, 1, 1,
+                        1 if getattr(node, "hdvm", None) else 0, 1 if size is None else 0)
+                for child in children:
+                    childsummary = self.summaries[child]
+                    summary.size += childsummary.size
+                    summary.nodes += childsummary.nodes
+                    summary.depth = max(summary.depth, childsummary.depth + 1)
+                    summary.used += childsummary.used
+                    summary.unknown += childsummary.unknown
+                self.summaries[uuid] = summary
+            return self.summaries[node_uuid]
+
+    def getorphans(self):
+        "Return a list of the roots of the trees that no vm uses any node of."
+        return [root for root in self.getroots() if self.getsummary(root.uuid).used == 0]
+
+    def getbylocation(self, location):
+        "Return the node with location, or None if there is no such node."
+        return self.bylocation.get(location)
+
+    def getattachedto(self, vm):
+        """
+        Return a list of nodes that have no children and are used by
+        vm.  vm is a string of either the vm's name or uuid.
+        """
+        return [self.nodes[uuid] for uuid in self.byvm.get(vm, {}) if uuid in self.ends]
+
+def iterHDDs(lines, forest=None):
+    """
+    Generate HDD objects from lines, an iterable of the lines of output
+    from `VBoxManage list hdds`.  The hdds are separated by blank lines.
+    Each HDD is made as soon as all of its lines have been read, so
+    lines can be read straight from the VBoxManage process.
+    """
+    block = []
+    for line in lines:
+        line = line.strip()
+        if line:
+            block.append(line)
+        elif block:
+            yield HDD(block, forest)
+            block = []
+    if block:
+        yield HDD(block, forest)
 
 def createHDDForest():
     """
     Return a Forest() object of all hdds available.
     This does not include snapshots.
     """
-    stdout = runcommand(["VBoxManage", "list", "hdds"])
-    stdout = stdout.strip()
-    lines = stdout.split("\n\n")
+    forest = Forest()
+    for hdd in iterHDDs(streamcommand(["VBoxManage", "list", "hdds"]), forest):
+        forest[hdd.uuid] = hdd
 
-    if len(lines) == 0:
+    if len(forest) == 0:
         print("ERROR: No hdds.")
         sys.exit(1)
 
-    forest = Forest()
-    for l in lines:
-        hdd = HDD(l.strip().split("\n"), forest)
-        forest[hdd.uuid] = hdd
-
     return forest
+
+def getHDD(disk, forest=None):
+    """
+    Return an HDD object for a single hard disk, from the output of
+    `VBoxManage showhdinfo`.  disk is the uuid or location of the hard
+    disk.  If forest is not None, the new HDD is also added to forest.
+    """
+    stdout = runcommand(["VBoxManage", "showhdinfo", disk])
+
+    hdd = HDD(stdout.strip().split("\n"), forest)
+    if forest is not None:
+        forest[hdd.uuid] = hdd
+    return hdd
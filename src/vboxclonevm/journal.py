@@ -0,0 +1,89 @@
+"""
+Module that keeps a journal of the steps of a clone that have been done,
+so that a clone that was interrupted (by an error from VBoxManage, or by
+the user) can carry on where it stopped when it is run again, instead of
+copying every hard disk again.
+
+The steps are "create", "options", "controller-NAME", "disk-N" and
+"attach-N".  The journal is kept in the cache directory until the clone
+has finished.
+"""
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from vboxclonevm.utils import *
+
+class Journal:
+    """
+    The steps of one clone that have been done, each with a dict of what
+    is needed to reuse its result.  Every step is written to filename as
+    soon as it is recorded.  Steps can be recorded from several threads
+    at once.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.lock = threading.Lock()
+        self.steps = {}
+        try:
+            with open(filename) as f:
+                self.steps = json.load(f)
+        except (IOError, OSError, ValueError):
+            pass
+
+    @classmethod
+    def forclone(cls, fromvmuuid, newname):
+        "Return the journal for cloning the vm with fromvmuuid to a vm called newname."
+        key = hashlib.sha1(("%s\n%s" % (fromvmuuid, newname)).encode('utf-8')).hexdigest()
+        return cls(os.path.join(cachedir(), "journal-%s.json" % key))
+
+    def __len__(self):
+        return len(self.steps)
+
+    def get(self, step):
+        "Return the dict recorded for step, or None if it hasn't been done."
+        with self.lock:
+            return self.steps.get(step)
+
+    def record(self, step, **data):
+        "Record that step has been done, along with data."
+        with self.lock:
+            self.steps[step] = data
+            self.__write()
+
+    def forget(self, step):
+        "Record that step has to be done again."
+        with self.lock:
+            if self.steps.pop(step, None) is not None:
+                self.__write()
+
+    def reset(self):
+        "Forget every step, to start the clone again from the beginning."
+        with self.lock:
+            self.steps = {}
+            self.__remove()
+
+    def remove(self):
+        "Remove the journal once the clone has finished."
+        self.reset()
+
+    def __write(self):
+        directory = os.path.dirname(self.filename)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(dir=directory, prefix=".journal")
+            with os.fdopen(fd, "w") as f:
+                json.dump(self.steps, f)
+            os.replace(tmpname, self.filename)
+        except (IOError, OSError) as e:
+            # the clone can go on, it just can't be resumed
+            print("WARNING: Could not write journal %s: %s" % (self.filename, e))
+
+    def __remove(self):
+        try:
+            os.unlink(self.filename)
+        except OSError:
+            pass
@@ -0,0 +1,156 @@
+"""
+Module for listing vms and hdds, as text or as JSON for scripts.  Used by
+the --list-* options of vbox-clone-vm and by the daemon.
+"""
+
+import json
+import os
+import sys
+
+from vboxclonevm.utils import *
+from vboxclonevm.vm import printVMs
+
+def formatsize(nbytes):
+    "Return nbytes as a string like \"12.3 MB\", or \"?\" if it is None."
+    if nbytes is None:
+        return "?"
+    return "%.1f MB" % (nbytes / (1024 * 1024))
+
+def findhdd(forest, disk):
+    "Return the hdd in forest with the uuid or location disk, or exit."
+    if disk in forest:
+        return forest[disk]
+    hdd = forest.getbylocation(disk) or forest.getbylocation(os.path.abspath(disk))
+    if hdd is None:
+        print("ERROR! No hdd with uuid or location \"%s\"." % disk)
+        sys.exit(1)
+    return hdd
+
+def hddrecord(hdd, forest):
+    "Return a dict describing hdd, for JSON."
+    return {
+            "uuid": hdd.uuid,
+            "parent": hdd.parentuuid if hdd.parentuuid != "base" else None,
+            "parentmissing": hdd.parentuuid != "base" and hdd.parentuuid not in forest,
+            "location": hdd.hdlocation,
+            "format": hdd.hdformat,
+            "state": hdd.hdstate,
+            "vm": hdd.hdvm,
+            "vmuuid": hdd.hdvmuuid,
+            "snapshot": hdd.hdsnapshot,
+            # how many hdds it is based on, so 0 for a base hdd
+            "chaindepth": len(forest.getchain(hdd.uuid)) - 1,
+            "size": forest.sizes.get(hdd.uuid),
+            }
+
+def treerecord(root, forest):
+    "Return a dict describing the tree with root, for JSON."
+    summary = forest.getsummary(root.uuid)
+    record = hddrecord(root, forest)
+    record.update({
+            "nodes": summary.nodes,
+            # how many hdds are on the longest chain, so 1 for a lone base
+            "longestchain": summary.depth,
+            "treesize": summary.size,
+            "unknownsizes": summary.unknown,
+            "used": summary.used,
+            "vms": sorted(set(hdd.hdvm for hdd in forest.getsubtree(root.uuid) if hdd.hdvm)),
+            })
+    return record
+
+def printjson(records):
+    "Print records as JSON."
+    sys.stdout.write(json.dumps(records, indent=2) + "\n")
+
+def printhdds(hdds, forest, asjson=False):
+    "Print hdds with their sizes, reading the sizes again."
+    forest.statsizes([hdd.uuid for hdd in hdds], refresh=True)
+    if asjson:
+        printjson([hddrecord(hdd, forest) for hdd in hdds])
+        return
+    for hdd in hdds:
+        print("%s  %10s  %s  (%s)" % (hdd.uuid, formatsize(forest.sizes.get(hdd.uuid)),
+            hdd.hdlocation, hdd.hdvm or ''))
+
+def listvms(vms, asjson=False):
+    "Print vms."
+    if asjson:
+        printjson([{"name": vm.name, "uuid": vm.uuid} for vm in vms])
+    else:
+        printVMs(vms)
+
+def listhdds(forest, asjson=False):
+    "Print the hdds that have no children."
+    ends = forest.getends()
+    if asjson:
+        forest.statsizes([hdd.uuid for hdd in ends], refresh=True)
+        printjson([hddrecord(hdd, forest) for hdd in ends])
+        return
+    for hdd in ends:
+        print("%s  (%s)" % (hdd.uuid, hdd.hdvm or ''))
+
+def listchain(forest, disk, asjson=False):
+    "Print the hdd with uuid or location disk and its ancestors, down to its base."
+    chain = forest.getchain(findhdd(forest, disk).uuid)
+    printhdds(chain, forest, asjson)
+    if not asjson and chain[-1].parentuuid != "base":
+        print("WARNING: Parent %s of %s is missing." % (chain[-1].parentuuid, chain[-1].uuid))
+
+def listsubtree(forest, disk, asjson=False):
+    "Print the hdd with uuid or location disk and everything based on it."
+    subtree = forest.getsubtree(findhdd(forest, disk).uuid)
+    printhdds(subtree, forest, asjson)
+    if not asjson:
+        summary = forest.getsummary(subtree[0].uuid)
+        print("%d hdds, longest chain %d, %s" % (summary.nodes, summary.depth,
+            formatsize(summary.size)))
+
+def listtrees(forest, orphans=False, asjson=False):
+    """
+    Print every tree of hdds with how many hdds are in it, how many are
+    on its longest chain, how much space it takes and the vms that use
+    it.  If orphans is True, only the trees that no vm uses are printed.
+    """
+    # one pass over all the files, which only forgets the summaries of
+    # the trees whose sizes changed
+    forest.statsizes(refresh=True)
+    roots = forest.getorphans() if orphans else forest.getroots()
+    records = [treerecord(root, forest) for root in roots]
+    if asjson:
+        printjson(records)
+        return
+    for record in records:
+        line = "%s  %4d hdds  longest chain %2d  %10s  %s  (%s)" % (record["uuid"],
+                record["nodes"], record["longestchain"], formatsize(record["treesize"]),
+                record["location"], ", ".join(record["vms"]))
+        if record["unknownsizes"]:
+            line += "  [%d unreadable]" % record["unknownsizes"]
+        if record["parentmissing"]:
+            line += "  [parent %s missing]" % record["parent"]
+        print(line)
+
+# the list commands listinventory() knows, which are also the names of
+# the --list-* options of vbox-clone-vm
+LISTCOMMANDS = ["list-vm-names", "list-vms", "list-hdds", "list-chain", "list-subtree",
+        "list-trees", "list-orphans"]
+
+def listinventory(inventory, command, disk=None, asjson=False):
+    """
+    Print what command, one of LISTCOMMANDS, lists from inventory.  disk
+    is the uuid or location of the hdd for list-chain and list-subtree.
+    If asjson is True, it is printed as JSON.
+    """
+    assert(command in LISTCOMMANDS)
+    if command == "list-vm-names":
+        for vm in inventory.vms:
+            print(vm.name)
+    elif command == "list-vms":
+        listvms(inventory.vms, asjson)
+    elif command == "list-hdds":
+        listhdds(inventory.forest, asjson)
+    elif command == "list-chain":
+        listchain(inventory.forest, disk, asjson)
+    elif command == "list-subtree":
+        listsubtree(inventory.forest, disk, asjson)
+    else:
+        listtrees(inventory.forest, command == "list-orphans", asjson)
@@ -0,0 +1,141 @@
+"""
+Module that decides where cloned hard disks go.  Provides the
+StoragePools class.
+
+A storage pool is a directory that cloned hard disks can be written to.
+Each disk goes to the pool where, going by the write rate measured for
+each pool in earlier runs, all the disks placed there so far would be
+finished soonest, as long as the pool has room for it.  Disks that fit
+nowhere are found before anything is copied.
+"""
+
+import json
+import os
+import sys
+import tempfile
+import threading
+
+from vboxclonevm.steps import COPY_RATE
+from vboxclonevm.utils import *
+
+# space to leave free in every pool, in bytes
+MIN_FREE = 256 * 1024 * 1024
+
+# how much a new measurement of a pool's write rate counts for against
+# the ones before it
+RATE_WEIGHT = 0.5
+
+class StoragePool:
+    "A directory to put hard disks in, and how much is going into it."
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        stat = os.statvfs(self.path)
+        self.free = stat.f_bavail * stat.f_frsize
+        self.reserved = 0
+
+    def available(self):
+        "Return how many bytes can still be put in this pool."
+        return self.free - self.reserved - MIN_FREE
+
+class StoragePools:
+    """
+    The storage pools at paths, shared by all the clones being made, so
+    the space given to one clone isn't given to another.  If
+    subdirectories is True, each vm's disks go in a directory named after
+    the vm in the pool.  Measured write rates are kept in ratesfile.
+    """
+    def __init__(self, paths, subdirectories=True, ratesfile=None):
+        if ratesfile is None:
+            ratesfile = os.path.join(cachedir(), "throughput.json")
+        self.ratesfile = ratesfile
+        self.subdirectories = subdirectories
+        self.lock = threading.Lock()
+        self.pools = []
+        for path in paths:
+            try:
+                self.pools.append(StoragePool(path))
+            except OSError as e:
+                print("ERROR! Could not use storage pool %s: %s" % (path, e))
+                sys.exit(1)
+        self.rates = self.__readrates()
+
+    def __readrates(self):
+        try:
+            with open(self.ratesfile) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def rate(self, pool):
+        "Return the bytes per second disks are expected to be written to pool at."
+        return self.rates.get(pool.path, COPY_RATE)
+
+    def poolof(self, directory):
+        "Return the pool that directory is in, or None."
+        directory = os.path.abspath(directory)
+        for pool in self.pools:
+            if directory == pool.path or directory.startswith(pool.path + os.sep):
+                return pool
+        return None
+
+    def rateof(self, directory):
+        "Return the bytes per second disks are expected to be written to directory at."
+        pool = self.poolof(directory)
+        if pool is None:
+            return COPY_RATE
+        return self.rate(pool)
+
+    def place(self, size, vmname):
+        """
+        Choose the pool to write a hard disk of size bytes for the vm
+        called vmname to, and set aside the space for it.  Return the
+        directory to write it to, or exit if no pool has room for it.
+        """
+        with self.lock:
+            fits = [pool for pool in self.pools if pool.available() >= size]
+            if not fits:
+                print("ERROR! Not enough free space for a %d MB hard disk in %s." % (
+                    size // (1024 * 1024), ", ".join(pool.path for pool in self.pools)))
+                sys.exit(1)
+
+            # finish soonest first, then the most room left
+            pool = min(fits, key=lambda pool: ((pool.reserved + size) / self.rate(pool),
+                -pool.available()))
+            pool.reserved += size
+
+        if self.subdirectories:
+            return os.path.join(pool.path, vmname)
+        return pool.path
+
+    def recordrate(self, directory, nbytes, seconds):
+        """
+        Record that nbytes were written to directory, in one of the
+        pools, in seconds, so later placements know how fast it is.
+        """
+        pool = self.poolof(directory)
+        if nbytes <= 0 or seconds <= 0 or pool is None:
+            return
+
+        with self.lock:
+            path = pool.path
+            rate = nbytes / seconds
+            if path in self.rates:
+                rate = RATE_WEIGHT * rate + (1 - RATE_WEIGHT) * self.rates[path]
+            self.rates[path] = rate
+
+            # other runs may have measured other pools meanwhile
+            rates = self.__readrates()
+            rates[path] = rate
+            self.__writerates(rates)
+
+    def __writerates(self, rates):
+        directory = os.path.dirname(self.ratesfile)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            fd, tmpname = tempfile.mkstemp(dir=directory, prefix=".throughput")
+            with os.fdopen(fd, "w") as f:
+                json.dump(rates, f)
+            os.replace(tmpname, self.ratesfile)
+        except (IOError, OSError) as e:
+            # placing disks just won't know about this measurement
+            print("WARNING: Could not write %s: %s" % (self.ratesfile, e))
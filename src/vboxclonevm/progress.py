@@ -0,0 +1,137 @@
+"""
+Module for reporting how hard disk copies are getting on.  VBoxManage
+prints "0%...10%...20%..." on stderr while it copies; runwithprogress()
+in utils parses that as it is written, and a ProgressReporter turns the
+percentages into bytes per second and time left for each disk, and the
+throughput of all the copies together.
+"""
+
+import datetime
+import sys
+import threading
+import time
+
+class DiskProgress:
+    """
+    How far the copy of one hard disk has got.  totalbytes is how many
+    bytes are expected to be copied, or None if that isn't known.
+    """
+    def __init__(self, name, totalbytes=None):
+        self.name = name
+        self.totalbytes = totalbytes
+        self.percent = 0
+        self.started = time.monotonic()
+        self.finished = None
+
+    def elapsed(self):
+        "Return the seconds since the copy started."
+        return (self.finished or time.monotonic()) - self.started
+
+    def bytesdone(self):
+        "Return roughly how many bytes have been copied, or None if unknown."
+        if self.totalbytes is None:
+            return None
+        return self.totalbytes * self.percent // 100
+
+    def bytespersecond(self):
+        "Return the average copy rate so far, or None if unknown."
+        elapsed = self.elapsed()
+        if self.totalbytes is None or elapsed <= 0:
+            return None
+        return self.bytesdone() / elapsed
+
+    def eta(self):
+        "Return the seconds until the copy should be done, or None if unknown."
+        if self.finished is not None:
+            return 0.0
+        if self.percent <= 0:
+            return None
+        return self.elapsed() * (100 - self.percent) / self.percent
+
+    def __str__(self):
+        parts = ["%s: %3d%%" % (self.name, self.percent)]
+        rate = self.bytespersecond()
+        if rate is not None:
+            parts.append(formatrate(rate))
+        eta = self.eta()
+        if eta is not None and self.finished is None:
+            parts.append("ETA %s" % datetime.timedelta(seconds=int(eta)))
+        return "  ".join(parts)
+
+def formatrate(bytespersecond):
+    "Return bytespersecond as a string like \"12.3 MB/s\"."
+    return "%.1f MB/s" % (bytespersecond / (1024 * 1024))
+
+class ProgressReporter:
+    """
+    Keeps track of the hard disks being copied, possibly from several
+    threads at once.  Each time a copy gets further, callback (if not
+    None) is called with the DiskProgress and this reporter, and unless
+    quiet is True a line is printed.
+    """
+    def __init__(self, callback=None, quiet=False):
+        self.callback = callback
+        self.quiet = quiet
+        self.disks = []
+        self.started = None
+        self.lock = threading.Lock()
+        self.printed = False
+
+    def start(self, name, totalbytes=None):
+        "Start reporting on a copy called name.  Return its DiskProgress."
+        disk = DiskProgress(name, totalbytes)
+        with self.lock:
+            if self.started is None:
+                self.started = disk.started
+            self.disks.append(disk)
+        return disk
+
+    def update(self, disk, percent):
+        "Record that disk is percent done."
+        # 100% is reported by finish(), with the final rate
+        if percent <= disk.percent or percent >= 100:
+            return
+        disk.percent = percent
+        self.__report(disk)
+
+    def finish(self, disk):
+        "Record that disk has been copied."
+        disk.percent = 100
+        disk.finished = time.monotonic()
+        self.__report(disk)
+
+    def cancel(self, disk):
+        "Stop reporting on disk, because it is going to be copied another way."
+        with self.lock:
+            self.disks.remove(disk)
+
+    def bytespersecond(self):
+        "Return the copy rate of all the disks together, or None if unknown."
+        with self.lock:
+            done = [disk.bytesdone() for disk in self.disks]
+            started = self.started
+        done = [n for n in done if n is not None]
+        if not done or started is None:
+            return None
+        elapsed = time.monotonic() - started
+        if elapsed <= 0:
+            return None
+        return sum(done) / elapsed
+
+    def __report(self, disk):
+        if self.callback:
+            self.callback(disk, self)
+        if self.quiet:
+            return
+
+        line = str(disk)
+        total = self.bytespersecond()
+        with self.lock:
+            if len(self.disks) > 1 and total is not None:
+                line += "  (all disks %s)" % formatrate(total)
+            # the first line starts below the "Copying storage devices" message
+            if not self.printed:
+                line = "\n" + line
+                self.printed = True
+            sys.stdout.write(line + "\n")
+            sys.stdout.flush()
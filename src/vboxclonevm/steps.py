@@ -0,0 +1,169 @@
+"""
+Module for running the steps of a clone in the order they depend on each
+other, as many at a time as allowed.  Provides the StepGraph class.
+
+Every VBoxManage command that changes a vm needs the vm's session lock,
+and fails if another command has it, so steps that change the same vm
+share a lock name and are never run at the same time.  Steps that don't
+need the lock, like copying hard disks, run alongside them.
+"""
+
+import contextvars
+import sys
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from vboxclonevm.utils import *
+
+# rough guesses, in seconds, of how long steps take, for the dry run
+COMMAND_COST = 0.2
+# bytes per second clonehd copies at, for guessing how long copies take
+COPY_RATE = 100 * 1024 * 1024
+
+class Step:
+    """
+    One step of a clone.  function is called with no arguments to do it.
+    The step is only started once all the steps named in after are done.
+    Steps with the same lock are never run at the same time, and steps
+    with the same group are limited by the groupjobs of StepGraph.run().
+    cost is a guess of how many seconds the step takes.
+    """
+    def __init__(self, name, function, after=(), lock=None, group=None,
+            cost=COMMAND_COST, description=""):
+        self.name = name
+        self.function = function
+        self.after = list(after)
+        self.lock = lock
+        self.group = group
+        self.cost = cost
+        self.description = description
+
+class StepGraph:
+    """
+    The steps of one or more clones and what each of them depends on.
+    Steps are run, and listed, in the order they were added when nothing
+    else decides it.  results maps the names of the steps that have been
+    done to what their functions returned.
+    """
+    def __init__(self):
+        self.steps = {}
+        self.results = {}
+
+    def add(self, name, function, after=(), lock=None, group=None,
+            cost=COMMAND_COST, description=""):
+        "Add a step, see Step.  Every step in after must have been added already."
+        assert(name not in self.steps)
+        for dependency in after:
+            assert(dependency in self.steps)
+        self.steps[name] = Step(name, function, after, lock, group, cost, description)
+        return name
+
+    def __len__(self):
+        return len(self.steps)
+
+    def criticalpath(self):
+        """
+        Return a tuple of the guessed number of seconds the whole graph
+        takes with unlimited jobs, and the list of steps on the longest
+        chain of dependencies, which decides that.
+        """
+        finish = {}
+        previous = {}
+        # steps can only depend on steps added before them, so this is
+        # already a topological order
+        for step in self.steps.values():
+            start = 0.0
+            previous[step.name] = None
+            for dependency in step.after:
+                if finish[dependency] > start:
+                    start = finish[dependency]
+                    previous[step.name] = dependency
+            finish[step.name] = start + step.cost
+
+        if not finish:
+            return 0.0, []
+        name = max(finish, key=finish.get)
+        total = finish[name]
+        path = []
+        while name is not None:
+            path.append(self.steps[name])
+            name = previous[name]
+        return total, path[::-1]
+
+    def describe(self):
+        "Return a list of lines describing the steps and the critical path."
+        total, path = self.criticalpath()
+        critical = set(step.name for step in path)
+        width = max([len(name) for name in self.steps] + [4])
+        lines = []
+        for step in self.steps.values():
+            line = "%s %-*s  %7.1f s  %s" % ("*" if step.name in critical else " ",
+                    width, step.name, step.cost, step.description)
+            if step.after:
+                line += "  (after %s)" % ", ".join(step.after)
+            lines.append(line)
+        lines.append("")
+        lines.append("Critical path (marked *), about %.1f s: %s" % (total,
+            " -> ".join(step.name for step in path)))
+        return lines
+
+    def run(self, jobs=1, groupjobs=None):
+        """
+        Run all the steps, at most jobs at a time, and at most groupjobs
+        (a number or a GroupLimit) from the same group at a time.  Return
+        results.  If a step fails, no more steps are started, and once the
+        running ones have finished the exception is raised again.
+        """
+        if groupjobs is None:
+            run = lambda group, function: function()
+        else:
+            if not isinstance(groupjobs, GroupLimit):
+                groupjobs = GroupLimit(groupjobs)
+            run = groupjobs.run
+
+        waiting = [step for step in self.steps.values() if step.name not in self.results]
+        running = {}
+        heldlocks = set()
+        failure = None
+
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            while waiting or running:
+                # start everything that is ready, in the order it was added
+                if failure is None:
+                    for step in list(waiting):
+                        if len(running) >= max(1, jobs):
+                            break
+                        if step.lock is not None and step.lock in heldlocks:
+                            continue
+                        if not all(dependency in self.results for dependency in step.after):
+                            continue
+                        waiting.remove(step)
+                        if step.lock is not None:
+                            heldlocks.add(step.lock)
+                        # each step runs in a copy of our context, so it
+                        # sees the same context variables as the caller
+                        future = executor.submit(contextvars.copy_context().run,
+                                run, step.group, step.function or (lambda: None))
+                        running[future] = step
+
+                if not running:
+                    if failure is None:
+                        print("ERROR! Steps %s depend on each other." %
+                                ", ".join(step.name for step in waiting))
+                        sys.exit(1)
+                    break
+
+                done, notdone = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    step = running.pop(future)
+                    if step.lock is not None:
+                        heldlocks.discard(step.lock)
+                    if future.exception() is not None:
+                        if failure is None:
+                            failure = future.exception()
+                        continue
+                    self.results[step.name] = future.result()
+
+        if failure is not None:
+            raise failure
+        return self.results
@@ -0,0 +1,224 @@
+"""
+Module that records how long every VBoxManage command takes.  Provides
+the TimingBackend, which wraps another backend and records each command in
+a Recorder, and phase(), which labels the commands run inside it with the
+step of the clone they belong to.
+"""
+
+import contextlib
+import contextvars
+import json
+import sys
+import threading
+import time
+
+from subprocess import PIPE
+
+from vboxclonevm.backend import Backend, getbackend, setbackend
+
+# the phase of the run that commands are being run for
+currentphase = contextvars.ContextVar("currentphase", default="other")
+
+@contextlib.contextmanager
+def phase(name):
+    "Label all the commands run inside the with statement with name."
+    token = currentphase.set(name)
+    try:
+        yield
+    finally:
+        currentphase.reset(token)
+
+class CommandRecord:
+    """
+    One command that was run: its arguments, the phase it was run in, how
+    many seconds it took, how many bytes it wrote to stdout and stderr
+    and its exit status.
+    """
+    def __init__(self, args, phasename, start, seconds, outputbytes, status):
+        self.args = list(args)
+        self.phase = phasename
+        self.start = start
+        self.seconds = seconds
+        self.outputbytes = outputbytes
+        self.status = status
+
+    def todict(self):
+        return {"args": self.args, "phase": self.phase, "start": self.start,
+                "seconds": self.seconds, "outputbytes": self.outputbytes,
+                "status": self.status}
+
+class Recorder:
+    "The CommandRecords of everything run in this run."
+    def __init__(self):
+        self.records = []
+        self.lock = threading.Lock()
+        self.start = time.perf_counter()
+
+    def record(self, args, start, outputbytes, status):
+        "Record a command that was started at start and just finished."
+        now = time.perf_counter()
+        with self.lock:
+            self.records.append(CommandRecord(args, currentphase.get(),
+                start - self.start, now - start, outputbytes, status))
+
+    def summary(self):
+        """
+        Return a dict mapping each phase to a dict with the number of
+        commands, total seconds, output bytes and failures in the phase,
+        in the order the phases started.
+        """
+        phases = {}
+        with self.lock:
+            records = list(self.records)
+        for record in records:
+            totals = phases.setdefault(record.phase,
+                    {"commands": 0, "seconds": 0.0, "outputbytes": 0, "failures": 0})
+            totals["commands"] += 1
+            totals["seconds"] += record.seconds
+            totals["outputbytes"] += record.outputbytes
+            if record.status:
+                totals["failures"] += 1
+        return phases
+
+    def printsummary(self, out=sys.stdout):
+        "Print a table of the time spent in each phase."
+        phases = self.summary()
+        out.write("\n%-14s %9s %11s %13s %9s\n" % ("phase", "commands", "seconds",
+            "output bytes", "failures"))
+        for name, totals in phases.items():
+            out.write("%-14s %9d %11.3f %13d %9d\n" % (name, totals["commands"],
+                totals["seconds"], totals["outputbytes"], totals["failures"]))
+        out.write("%-14s %9d %11.3f (wall time of the whole run)\n" % ("total",
+            sum(totals["commands"] for totals in phases.values()),
+            time.perf_counter() - self.start))
+
+    def writejson(self, filename, vboxversion=None):
+        "Write every record and the per-phase summary to filename as JSON."
+        with self.lock:
+            records = [record.todict() for record in self.records]
+        report = {
+                "vboxversion": vboxversion,
+                "seconds": time.perf_counter() - self.start,
+                "phases": self.summary(),
+                "commands": records,
+                }
+        with open(filename, "w") as f:
+            json.dump(report, f, indent=2)
+
+class CountingStream:
+    "A binary stream that counts how many bytes have been read from it."
+    def __init__(self, stream):
+        self.stream = stream
+        self.count = 0
+
+    def __iter__(self):
+        for line in self.stream:
+            self.count += len(line)
+            yield line
+
+    def read(self, *args):
+        data = self.stream.read(*args)
+        self.count += len(data)
+        return data
+
+    def read1(self, *args):
+        data = self.stream.read1(*args)
+        self.count += len(data)
+        return data
+
+    def readline(self, *args):
+        data = self.stream.readline(*args)
+        self.count += len(data)
+        return data
+
+    def fileno(self):
+        return self.stream.fileno()
+
+    def close(self):
+        self.stream.close()
+
+class TimedProcess:
+    """
+    Wraps a Popen-like object, and records the command when it is
+    waited for.
+    """
+    def __init__(self, process, recorder, args, start):
+        self.process = process
+        self.recorder = recorder
+        self.args = args
+        self.start = start
+        self.recorded = False
+        self.stdout = CountingStream(process.stdout) if process.stdout else None
+        self.stderr = CountingStream(process.stderr) if process.stderr else None
+
+    @property
+    def returncode(self):
+        return self.process.returncode
+
+    def __record(self):
+        if not self.recorded:
+            self.recorded = True
+            outputbytes = sum(stream.count for stream in [self.stdout, self.stderr] if stream)
+            self.recorder.record(self.args, self.start, outputbytes, self.process.returncode)
+
+    def poll(self):
+        returncode = self.process.poll()
+        if returncode is not None:
+            self.__record()
+        return returncode
+
+    def wait(self):
+        returncode = self.process.wait()
+        self.__record()
+        return returncode
+
+    def communicate(self):
+        stdout, stderr = self.process.communicate()
+        if self.stdout:
+            self.stdout.count += len(stdout)
+        if self.stderr:
+            self.stderr.count += len(stderr)
+        self.__record()
+        return stdout, stderr
+
+class TimingBackend(Backend):
+    "Run commands with another backend, recording each of them in recorder."
+    def __init__(self, backend, recorder):
+        self.backend = backend
+        self.recorder = recorder
+
+    def run(self, args):
+        process = self.popen(args)
+        stdout, stderr = process.communicate()
+        return stdout.decode('utf-8'), stderr.decode('utf-8')
+
+    def popen(self, args, stdout=PIPE, stderr=PIPE):
+        start = time.perf_counter()
+        process = self.backend.popen(args, stdout, stderr)
+        return TimedProcess(process, self.recorder, args, start)
+
+def startprofiling():
+    """
+    Record every command run from now on.  Return the Recorder they are
+    recorded in.
+    """
+    recorder = Recorder()
+    setbackend(TimingBackend(getbackend(), recorder))
+    return recorder
+
+def reportprofile(recorder, filename="-"):
+    """
+    Print the summary of recorder, or if filename isn't "-", write all
+    of it to filename as JSON along with the VirtualBox version.
+    """
+    if filename == "-":
+        recorder.printsummary()
+        return
+
+    # don't record the version check itself
+    backend = getbackend()
+    if isinstance(backend, TimingBackend):
+        backend = backend.backend
+    stdout, stderr = backend.run(["VBoxManage", "--version"])
+    recorder.writejson(filename, stdout.strip() or None)
+    print("Wrote profile to %s" % filename)
@@ -3,20 +3,43 @@
 Various utilities for working with VirtualBox VMs and HDDs.
 """
 
+import contextvars
 import os
 import re
 import sys
+import tempfile
+import threading
 
-from subprocess import Popen, PIPE
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import PIPE
 
-def storagetype(devuuid):
+from vboxclonevm.backend import getbackend
+
+class Medium:
     """
-    Return the storage type for the device with uuid devuuid.
-    If the storage type is a host dvd, return the string "hostdvd".
-    If the storage type is a host floppy, return the string "hostfloppy".
-    If the storage type is a floppy, return the string "floppy".
-    If the storage type is a dvd, return the string "dvd".
-    If the storage type is a hdd, return the string "hdd".
+    An entry for a medium in the MediaCatalog.
+    """
+    def __init__(self, uuid, mediumtype, location=None, size=None):
+        self.uuid = uuid
+        self.mediumtype = mediumtype
+        self.location = location
+        self.size = size
+
+    def __str__(self):
+        return "Medium(uuid: %s, type: %s, location: %s, size: %s)" % (
+                self.uuid, self.mediumtype, self.location, self.size)
+
+    def __repr__(self):
+        return self.__str__()
+
+class MediaCatalog:
+    """
+    Catalog of all the media VirtualBox knows about, keyed by uuid.
+
+    Each `VBoxManage list` command is only run once, the first time a
+    medium can't be found in the lists that have already been read.  Call
+    invalidate() after creating or deleting media so that the lists are
+    read again.
     """
     listcommands = [
             ("hostdvds", "hostdvd"),
@@ -26,17 +49,100 @@ def storagetype(devuuid):
             ("hdds", "hdd"),
             ]
 
-    for c, ret in listcommands:
-        stdout = runcommand(["VBoxManage", "list", c])
-        lines = stdout.strip().split('\n')
-        for l in lines:
-            m = re.match(r'^UUID:\s+%s$' % devuuid, l)
-            if m:
-                return ret
-            else:
+    sizeunits = {
+            "bytes": 1,
+            "kbytes": 1024,
+            "mbytes": 1024 ** 2,
+            "gbytes": 1024 ** 3,
+            "tbytes": 1024 ** 4,
+            }
+
+    def __init__(self):
+        self.media = {}
+        self.loaded = set()
+
+    def __load(self, command, mediumtype):
+        "Read the output of `VBoxManage list command` into the catalog."
+        stdout = runcommand(["VBoxManage", "list", command])
+        for block in stdout.strip().split("\n\n"):
+            fields = {}
+            for line in block.strip().split("\n"):
+                key, sep, value = line.partition(":")
+                if sep:
+                    fields[key.strip()] = value.strip()
+            uuid = fields.get("UUID")
+            if not uuid:
                 continue
+            location = fields.get("Location") or fields.get("Path") or fields.get("Name")
+            size = self.__parsesize(fields.get("Capacity") or fields.get("Size"))
+            self.media[uuid] = Medium(uuid, mediumtype, location, size)
+        self.loaded.add(mediumtype)
+
+    def __parsesize(self, string):
+        "Return the number of bytes in a size like \"10240 MBytes\", or None."
+        if not string:
+            return None
+        m = re.match(r'^(\d+)\s*(\w+)', string)
+        if not m or m.group(2).lower() not in self.sizeunits:
+            return None
+        return int(m.group(1)) * self.sizeunits[m.group(2).lower()]
 
-    return None
+    def get(self, uuid):
+        "Return the Medium with uuid, or None if there is no such medium."
+        for command, mediumtype in self.listcommands:
+            if uuid in self.media:
+                break
+            if mediumtype not in self.loaded:
+                self.__load(command, mediumtype)
+        return self.media.get(uuid)
+
+    def add(self, medium):
+        "Add medium, a Medium object, to the catalog."
+        self.media[medium.uuid] = medium
+
+    def addhdds(self, hdds):
+        """
+        Fill in the hdds from hdds, HDD objects for all the hdds that
+        `VBoxManage list hdds` would list (like the ones in a Forest), so
+        it doesn't have to be run again.
+        """
+        for hdd in hdds:
+            self.media[hdd.uuid] = Medium(hdd.uuid, "hdd", hdd.hdlocation)
+        self.loaded.add("hdd")
+
+    def invalidate(self, mediumtype=None):
+        """
+        Forget the media of mediumtype (for instance "hdd"), or all media
+        if mediumtype is None.  They will be reread when next needed.
+        """
+        if mediumtype is None:
+            self.media = {}
+            self.loaded = set()
+            return
+        self.media = dict((uuid, medium) for uuid, medium in self.media.items()
+                if medium.mediumtype != mediumtype)
+        self.loaded.discard(mediumtype)
+
+    def storagetype(self, devuuid):
+        "Return the storage type for the device with uuid devuuid, or None."
+        medium = self.get(devuuid)
+        if medium:
+            return medium.mediumtype
+        return None
+
+# the catalog of media shared by everything in this run
+mediacatalog = MediaCatalog()
+
+def storagetype(devuuid):
+    """
+    Return the storage type for the device with uuid devuuid.
+    If the storage type is a host dvd, return the string "hostdvd".
+    If the storage type is a host floppy, return the string "hostfloppy".
+    If the storage type is a floppy, return the string "floppy".
+    If the storage type is a dvd, return the string "dvd".
+    If the storage type is a hdd, return the string "hdd".
+    """
+    return mediacatalog.storagetype(devuuid)
 
 def runcommand(args):
     """
@@ -44,20 +150,110 @@ def runcommand(args):
     If anything is found on stderr, exit.
     Return stdout.
     """
-    stdout, stderr = Popen(args, stdout=PIPE, stderr=PIPE).communicate()
-    stdout = stdout.decode('utf-8')
-    stderr = stderr.decode('utf-8')
+    stdout, error = trycommand(args)
+    if error:
+        print(error)
+        sys.exit(1)
+
+    return stdout
+
+def trycommand(args):
+    """
+    Run a command and check stderr, like runcommand(), but don't exit
+    if something is wrong.
+    Return a tuple of stdout and an error message.  The error message is
+    None if nothing was found on stderr and there was no warning.
+    """
+    stdout, stderr = getbackend().run(args)
 
     if stderr:
-        print("ERROR! Could not run command %s:\n%s" % (args, stderr))
-        sys.exit(1)
+        return stdout, "ERROR! Could not run command %s:\n%s" % (args, stderr)
 
     warning = checkWarning(stdout)
     if warning:
-        print(warning)
-        sys.exit(1)
+        return stdout, warning
 
-    return stdout
+    return stdout, None
+
+def streamcommand(args):
+    """
+    Run a command and generate the lines of its stdout as they are
+    written, without reading all of stdout into memory first.
+    Like runcommand(), exit if there is a warning at the start of stdout
+    or anything is found on stderr.
+    """
+    with tempfile.TemporaryFile() as stderrfile:
+        process = getbackend().popen(args, stdout=PIPE, stderr=stderrfile)
+        warning = None
+        firstline = True
+        for line in process.stdout:
+            line = line.decode('utf-8')
+            if warning is not None:
+                if line.startswith("UUID:"):
+                    break
+                warning += line
+                continue
+            if firstline and line.startswith("WARNING: "):
+                warning = line
+                continue
+            firstline = False
+            yield line
+        process.stdout.close()
+        process.wait()
+
+        if warning is not None:
+            print(warning.rstrip("\n"))
+            sys.exit(1)
+
+        stderrfile.seek(0)
+        stderr = stderrfile.read().decode('utf-8')
+        if stderr:
+            print("ERROR! Could not run command %s:\n%s" % (args, stderr))
+            sys.exit(1)
+
+# a "10%..." progress marker, with any dots left over from the one before
+progressre = re.compile(r"\.*(\d+)%\.*")
+# the end of a chunk that might be the start of a progress marker
+partialprogressre = re.compile(r"[\d.]*$")
+
+def runwithprogress(args, onprogress):
+    """
+    Run a command that prints "0%...10%..." on stderr as it goes, like
+    `VBoxManage clonehd`, calling onprogress with each percentage as soon
+    as it is written.  Return a tuple of stdout and whatever else was on
+    stderr, as strings.  Only the stderr that isn't progress is kept.
+    """
+    with tempfile.TemporaryFile() as stdoutfile:
+        process = getbackend().popen(args, stdout=stdoutfile, stderr=PIPE)
+        read = getattr(process.stderr, "read1", process.stderr.read)
+        pending = ""
+        other = []
+        while True:
+            chunk = read(4096)
+            if chunk:
+                pending += chunk.decode('utf-8', 'replace')
+            position = 0
+            for m in progressre.finditer(pending):
+                other.append(pending[position:m.start()])
+                onprogress(int(m.group(1)))
+                position = m.end()
+            pending = pending[position:]
+            if not chunk:
+                break
+            # keep the end if it might be cut off in the middle of a marker
+            tail = partialprogressre.search(pending).start()
+            other.append(pending[:tail])
+            pending = pending[tail:]
+        other.append(pending)
+        process.stderr.close()
+        process.wait()
+
+        stdoutfile.seek(0)
+        stdout = stdoutfile.read().decode('utf-8')
+    stderr = "".join(other)
+    if not stderr.strip():
+        stderr = ""
+    return stdout, stderr
 
 def checkWarning(stdout):
     """
@@ -77,4 +273,57 @@ def checkWarning(stdout):
 def hddsattachedto(vm, hddforest):
     "Return a list of all hdds attached to a vm with a uuid of vmuuid."
     assert(type(vm) == type(""))
-    return [hdd for hdd in hddforest.getends() if hdd.hdvm == vm or hdd.hdvmuuid == vm]
+    return hddforest.getattachedto(vm)
+
+def filesystemof(path):
+    "Return an id for the filesystem that path is on."
+    return os.stat(path).st_dev
+
+def cachedir():
+    "Return the directory the cache and clone journals are kept in."
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache")
+    return os.path.join(base, "vbox-clone-vm")
+
+class GroupLimit:
+    """
+    Limit how many functions from the same group run at the same time.
+    A GroupLimit can be shared between several calls to runconcurrently()
+    running in different threads, so the limit holds across all of them.
+    """
+    def __init__(self, limit):
+        self.limit = limit
+        self.semaphores = {}
+        self.lock = threading.Lock()
+
+    def run(self, group, function):
+        "Call function once fewer than limit functions from group are running."
+        with self.lock:
+            semaphore = self.semaphores.setdefault(group, threading.BoundedSemaphore(self.limit))
+        with semaphore:
+            return function()
+
+def runconcurrently(tasks, jobs=1, groupjobs=None):
+    """
+    Call each function in tasks, a list of (group, function) tuples, and
+    return a list of their results in the same order as tasks.
+
+    At most jobs functions are run at the same time, and if groupjobs is
+    not None, at most groupjobs functions from the same group.  groupjobs
+    is either a number or a GroupLimit.
+    """
+    if groupjobs is None:
+        run = lambda group, function: function()
+    else:
+        if not isinstance(groupjobs, GroupLimit):
+            groupjobs = GroupLimit(groupjobs)
+        run = groupjobs.run
+
+    if jobs <= 1:
+        return [run(group, function) for group, function in tasks]
+
+    # each function runs in a copy of our context, so it sees the same
+    # context variables (like the timing phase) as the caller
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, run, group, function)
+                for group, function in tasks]
+        return [future.result() for future in futures]
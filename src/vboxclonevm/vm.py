@@ -1,348 +1,768 @@
 
 """
-Module that deals with VirtualBox VMs.  Provides the VM class and helper
-functions.
+Module that deals with VirtualBox VMs.  Provides the VM and ClonePlan
+classes and helper functions.
 """
 
 import os
 import re
 import sys
-
-from vboxclonevm.hdd import createHDDForest
+import threading
+import time
+
+from vboxclonevm.fastcopy import copyimage
+from vboxclonevm.hdd import HDD, getHDD
+from vboxclonevm.journal import Journal
+from vboxclonevm.pools import StoragePools
+from vboxclonevm.progress import ProgressReporter
+from vboxclonevm.steps import COMMAND_COST, COPY_RATE, StepGraph
+from vboxclonevm.timing import phase
 from vboxclonevm.utils import *
+from vboxclonevm.vminfo import getvminfo, invalidatevminfo
 
-class VM:
+class OptionBatch:
     """
-    An object that represents a VirtualBox VM.
+    Options to set on a vm with `VBoxManage modifyvm`.  Options are
+    collected with add() and then all set with a single modifyvm call
+    by apply().
     """
-    def __init__(self, line, hddforest):
-        self.hddforest = hddforest
+    def __init__(self, vmuuid):
+        self.vmuuid = vmuuid
+        self.options = {}
 
-        m = re.match(r'^"(.+?)" {([\w\d-]+)}$', line)
-        assert(len(m.groups()) == 2)
-        self.name = m.group(1)
-        self.uuid = m.group(2)
-        self.info = None
+    def __len__(self):
+        return len(self.options)
 
-    def __str__(self):
-        return "VM(name: %s, uuid: %s)" % (self.name, self.uuid)
-
-    def __repr__(self):
-        return self.__str__()
+    def add(self, option, value):
+        "Add the option --option with value to the batch."
+        self.options[option] = value
 
-    def fillininfo(self):
-        stdout = runcommand(["VBoxManage", "showvminfo", self.uuid, "--machinereadable"])
-        lines = stdout.strip().split('\n')
-
-        def create_values(line):
-            def take_out_quotes(string):
-                if len(string) <= 2:
-                    return string
-                if string[0] == '"':
-                    string = string[1:]
-                if string[-1] == '"':
-                    string = string[:-1]
-                return string
-
-            key, value = line.strip().split('=')
-            return take_out_quotes(key), take_out_quotes(value)
-
-        self.info = {}
-        for line in lines:
-            key, value = create_values(line)
-
-            # this is a hack because the value of firmware ("BIOS") is
-            # capitalized when it should not be.
-            if key.lower() == "firmware":
-                value = value.lower()
-
-            self.info[key.lower()] = value
-
-    def __setoption(self, fromvm, option):
+    def apply(self):
         """
-        Set an option from another vm.  fromvm must have a dictionary
-        "info" that has its options and values.
-        
-        Returns True if option was set, and False if not.
+        Set all the options in the batch.  If VBoxManage fails to set
+        them all in one call, set them one at a time so the failing
+        option is the one that gets reported.
         """
-        if option in fromvm.info.keys():
-            runcommand(["VBoxManage", "modifyvm", self.uuid,
-                "--%s" % option, "%s" % fromvm.info[option]])
-            #print("Setting option --%s to \"%s\"" % (option, fromvm.info[option]))
-            return True
-        else:
-            #print("Not setting option --%s because other vm does not have it set." % option)
-            return False
+        if not self.options:
+            return
 
-    def __setstoragecontrolleroption(self, fromvm, name, stype, bootable):
-        """
-        Set a storage option from another vm.  fromvm must have a dictionary
-        "info" that has its options and values.
-        
-        Returns True if option was set, and False if not.
-        """
-        vmoptions = fromvm.info.keys()
-        if name in vmoptions and stype in vmoptions:
-            cmdline = ["VBoxManage", "storagectl", self.uuid,
-                "--name", fromvm.info[name], "--controller", fromvm.info[stype]]
-
-            if bootable in vmoptions:
-                cmdline.append("--bootable")
-                cmdline.append(fromvm.info[bootable])
-
-            contype = fromvm.info[stype]
-            cmdline.append("--add")
-            if contype in ["PIIX4", "PIIX3", "ICH6"]:
-                cmdline.append("ide")
-            elif contype in ["I82078"]:
-                cmdline.append("floppy")
-            elif contype in ["IntelAhci"]:
-                cmdline.append("sata")
-            elif contype in ["LsiLogic", "BusLogic"]:
-                cmdline.append("scsi")
-            elif contype in ["LSILogicSAS", "BusLogic"]:
-                cmdline.append("sas")
-            elif contype in ["unknown"]:
-                #print("Not setting storage controller because type is unknown.")
-                return True
-            else:
-                print("ERROR! Could not figure out controller type.")
-                sys.exit(1)
+        cmdline = ["VBoxManage", "modifyvm", self.vmuuid]
+        for option, value in self.options.items():
+            cmdline.append("--%s" % option)
+            cmdline.append("%s" % value)
+        stdout, error = trycommand(cmdline)
 
-            runcommand(cmdline)
-            #print("Setting storrage controller option.")
-            return True
-        else:
-            #print("Not setting storage controller because other vm does not have it set.")
-            return False
+        if error:
+            for option, value in self.options.items():
+                runcommand(["VBoxManage", "modifyvm", self.vmuuid,
+                    "--%s" % option, "%s" % value])
 
-    def __setstoragedevices(self, fromvm):
-        """
-        Set the storage devices from the new vm from the old vm, 
-        cloning them if necessary.
-        """
-        cloned_hdds = 1
-        # get all the storage controller name and type options
-        nameopts = [opt for opt in fromvm.info.keys() if opt.startswith("storagecontrollername")]
-        typeopts = [opt for opt in fromvm.info.keys() if opt.startswith("storagecontrollertype")]
-        nameopts.sort()
-        typeopts.sort()
-        allopts = zip(nameopts, typeopts)
-        #print()
-        for nameopt, typeopt in allopts:
-            name = fromvm.info[nameopt]
-            taip = fromvm.info[typeopt]
-            if taip == "unknown":
+        self.options = {}
+        invalidatevminfo(self.vmuuid)
+
+class ClonePlan:
+    """
+    Everything that has to be copied from a vm to make a clone of it.
+    The plan is worked out once, and can then be applied to any number
+    of new vms with VM.applyplan().
+
+    If linked is True, the clones get differencing disks of the vm's hard
+    disks instead of copies, so a snapshot of the vm is taken (named
+    snapshotname) to stop its hard disks from changing.  If dryrun is
+    True the plan is only going to be described, so no snapshot is taken.
+
+    If fastcopy is True, hard disks that are a single VDI file are copied
+    with a reflink or copy_file_range() where the filesystem supports it,
+    and given a new uuid, instead of being copied by clonehd.
+
+    pools is a StoragePools to place copied hard disks in, or None to put
+    them next to each clone's settings file.  The clones share the pools
+    either way, so the space set aside for one clone's disks isn't given
+    to another's.
+    """
+    options_to_copy = [
+            "accelerate3d",
+            "acpi",
+            "audio",
+            "boot1",
+            "boot2",
+            "boot3",
+            "boot4",
+            "clipboard",
+            "cpus",
+            "firmware",
+            "guestmemoryballoon",
+            "hpet"
+            "hwvirtex",
+            "hwvirtexexl",
+            "ioacpi",
+            "largepages",
+            "memory",
+            "monitorcount",
+            "nextedpaging",
+            "pae",
+            "rtcseutc",
+            "usb",
+            "usbehci",
+            "vram",
+            "vrdeaddress",
+            "vrdeauthtype",
+            "vrdeauthtype",
+            "vrdemulticon",
+            "vrdeport",
+            "vrdereusecon",
+            "vrdevideochannel",
+            "vrdevideochannelquality",
+            "vtxvpid",
+            ]
+
+    def __init__(self, fromvm, hddforest, linked=False, snapshotname=None, fastcopy=False,
+            dryrun=False, pools=None):
+        self.fromvm = fromvm
+        self.hddforest = hddforest
+        self.linked = linked
+        self.fastcopy = fastcopy
+        self.pools = pools
+        # the pools the clones' settings files are in, by directory
+        self.defaultpools = {}
+        self.lock = threading.Lock()
+
+        fromvm.fillininfo()
+        self.ostype = fromvm.ostype()
+
+        # the options to set with modifyvm, including the nic options
+        self.options = {}
+        for option in self.options_to_copy:
+            if option in fromvm.info:
+                self.options[option] = fromvm.info[option]
+        for nic in fromvm.info.nics.values():
+            self.options.update(nic)
+
+        self.controllers = fromvm.controllers()
+
+        # list of (controllername, port, device, mediumtype, medium) tuples
+        # in the order the devices are attached.  mediumtype is "emptydrive"
+        # or the storagetype() of the medium.  medium is None for empty
+        # drives, the HDD object for hard disks and the image uuid for
+        # everything else.
+        self.attachments = []
+        self.__planattachments()
+
+        if linked and self.hdds() and not dryrun:
+            if snapshotname is None:
+                snapshotname = "Linked clone of %s" % fromvm.name
+            with phase("snapshot"):
+                self.__takesnapshot(snapshotname)
+
+    def defaultpool(self, directory):
+        "Return the StoragePools for putting disks next to the settings files of vms in directory."
+        with self.lock:
+            if directory not in self.defaultpools:
+                self.defaultpools[directory] = StoragePools([directory])
+            return self.defaultpools[directory]
+
+    def __planattachments(self):
+        "Fill in attachments from the old vm's storage controllers."
+        for controller in self.controllers:
+            name = controller.name
+            if controller.controllertype == "unknown":
                 # we don't know what do to with unknown devices
                 print("Skipping unknown device...")
                 continue
-            #print("name: %s (%s), type: %s (%s)" % (name, nameopt, taip, typeopt))
 
-            #controlleropts = [opt for opt in fromvm.info.keys() if opt.startswith(name.lower())]
-            controlleropts = [opt for opt in fromvm.info.keys() if
-                    re.match(r'^%s-\d\d?-\d\d?$' % name.lower(), opt)]
-            for controlopt in controlleropts:
-                if fromvm.info[controlopt] == "none":
+            for storagedevice in controller.devices:
+                if storagedevice.medium == "none":
                     # there is nothing here, just ignore it
-                    #print("\t(none)")
                     continue
 
-                # try to figure out whether this has an imageuuid varaiable associated with it
-                m = re.match(r'^(.*?)-(\d\d?)-(\d\d?)$', controlopt)
-                assert(m)
-                tmpname = m.group(1)
-                port = m.group(2)
-                device = m.group(3)
-                imageuuidopt = "%s-imageuuid-%s-%s" % (tmpname, port, device)
-                imageuuid = None
-                if imageuuidopt in fromvm.info:
-                    imageuuid = fromvm.info[imageuuidopt]
-
-                if fromvm.info[controlopt] == "emptydrive":
-                    # attach empty drive
-                    #print("\tAttaching empty device to %s... " % name)
-                    cmdline = ["VBoxManage", "storageattach", self.uuid,
-                        "--storagectl", name,
-                        "--port", port,
-                        "--device", device,
-                        "--medium", "emptydrive"]
-                    runcommand(cmdline)
+                port = storagedevice.port
+                device = storagedevice.device
+                imageuuid = storagedevice.imageuuid
+
+                if storagedevice.medium == "emptydrive":
+                    self.attachments.append((name, port, device, "emptydrive", None))
                     continue
 
-                #print("\t%s: %s" % (controlopt, fromvm.info[controlopt]))
                 #print("\timageuuid: %s" % imageuuid)
                 assert(imageuuid)
 
                 strgtype = storagetype(imageuuid)
                 #print("\tstorage type: %s" % strgtype)
                 if strgtype in ["dvd", "floppy", "hostdvd", "hostfloppy"]:
-                    #print("\tAttaching %s to %s... " % (strgtype, name))
-                    cmdline = ["VBoxManage", "storageattach", self.uuid,
-                        "--storagectl", name,
-                        "--port", port,
-                        "--device", device,]
-
-                    cmdline.append("--medium")
-                    if strgtype in ["hostdvd", "hostfloppy"]:
-                        cmdline.append("host:%s" % imageuuid)
-                    else:
-                        cmdline.append("%s" % imageuuid)
-
-                    cmdline.append("--type")
-                    if strgtype in ["dvd", "hostdvd"]:
-                        cmdline.append("dvddrive")
-                    if strgtype in ["floppy", "hostfloppy"]:
-                        cmdline.append("floppy")
-
-                    runcommand(cmdline)
+                    self.attachments.append((name, port, device, strgtype, imageuuid))
                     continue
 
                 # it wasn't an empty drive, or a dvd/floppy drive, so it must be a hard drive
                 assert(strgtype == "hdd")
-                #print("fromvm: %s" % fromvm)
-                #print("hddforest: %s" % self.hddforest)
-                hdds = hddsattachedto(fromvm.uuid, self.hddforest)
+                hdds = hddsattachedto(self.fromvm.uuid, self.hddforest)
                 #print("hdds: %s" % hdds)
 
                 # get the hdd whose uuid matches imageuuid
                 tmphdds = [hdd for hdd in hdds if hdd.uuid == imageuuid]
                 assert(len(tmphdds) == 1)
                 hdd = tmphdds[0]
-                #print("hdd: %s" % hdd)
-                self.fillininfo()
-                #print("self info: %s" % self.info)
-                # just look for the config file and assume we 
-                # can throw the hdd in the same dir
-                configfile = self.info["cfgfile"]
-                assert(os.path.isfile(configfile))
-                dirname = os.path.dirname(configfile)
 
-                newlocation = os.path.join(dirname, "%s-%s.vdi" % (self.name, cloned_hdds))
-                cmdline = ["VBoxManage", "clonehd", hdd.uuid, newlocation]
-                #print("cmdline: %s" % cmdline)
-                stdout, stderr = Popen(cmdline, stdout=PIPE,
-                        stderr=PIPE).communicate()
-                stdout = stdout.decode('utf-8')
-                stderr = stderr.decode('utf-8')
+                if self.linked:
+                    self.__checkchain(hdd)
+
+                self.attachments.append((name, port, device, "hdd", hdd))
+
+    def __checkchain(self, hdd):
+        "Make sure the whole differencing chain of hdd is known."
+        chain = self.hddforest.getchain(hdd.uuid)
+        if chain[-1].parentuuid != "base":
+            print("ERROR! Can't link to hdd %s, because its parent %s is missing." %
+                    (hdd.uuid, chain[-1].parentuuid))
+            sys.exit(1)
+        print("Linking to hdd %s with base %s (differencing chain depth %d)" %
+                (hdd.uuid, chain[-1].uuid, len(chain) + 1))
+
+    def __takesnapshot(self, snapshotname):
+        """
+        Take a snapshot of the old vm, so that its current hdds are no
+        longer written to.  The new differencing hdds that the old vm is
+        now using are added to the forest.
+        """
+        fromvm = self.fromvm
+        olduuids = set(hdd.uuid for hdd in self.hdds())
+        hddslots = set()
+        for controller in fromvm.controllers():
+            for storagedevice in controller.devices:
+                if storagedevice.imageuuid in olduuids:
+                    hddslots.add((controller.name, storagedevice.port, storagedevice.device))
+
+        runcommand(["VBoxManage", "snapshot", fromvm.uuid, "take", snapshotname])
+        fromvm.invalidateinfo()
+
+        for controller in fromvm.controllers():
+            for storagedevice in controller.devices:
+                slot = (controller.name, storagedevice.port, storagedevice.device)
+                imageuuid = storagedevice.imageuuid
+                if slot in hddslots and imageuuid not in self.hddforest:
+                    newhdd = getHDD(imageuuid, self.hddforest)
+                    mediacatalog.add(Medium(newhdd.uuid, "hdd", newhdd.hdlocation))
+
+    def hdds(self):
+        "Return a list of the HDD objects that have to be cloned."
+        return [medium for name, port, device, mediumtype, medium in self.attachments
+                if mediumtype == "hdd"]
+
+class VM:
+    """
+    An object that represents a VirtualBox VM.
+    """
+    def __init__(self, line, hddforest):
+        self.hddforest = hddforest
+
+        m = re.match(r'^"(.+?)" {([\w\d-]+)}$', line)
+        assert(len(m.groups()) == 2)
+        self.name = m.group(1)
+        self.uuid = m.group(2)
+        self.info = None
+
+    def __str__(self):
+        return "VM(name: %s, uuid: %s)" % (self.name, self.uuid)
+
+    def __repr__(self):
+        return self.__str__()
+
+    def fillininfo(self):
+        """
+        Fill in info with the vm's options.  The options are only read
+        from VirtualBox if they aren't already cached.
+        """
+        self.info = getvminfo(self.uuid)
+
+    def invalidateinfo(self):
+        "Forget the vm's cached options.  Call this after changing the vm."
+        invalidatevminfo(self.uuid)
+
+    def cfgfile(self):
+        "Return the path to the vm's settings file."
+        self.fillininfo()
+        return self.info.cfgfile()
+
+    def ostype(self):
+        "Return the vm's os type."
+        self.fillininfo()
+        return self.info.ostype()
+
+    def controllers(self):
+        "Return a list of the vm's StorageController objects, in order."
+        self.fillininfo()
+        return self.info.controllers()
+
+    def __setstoragecontroller(self, controller):
+        """
+        Add a storage controller like controller, a StorageController
+        from another vm.
+        """
+        cmdline = ["VBoxManage", "storagectl", self.uuid,
+            "--name", controller.name, "--controller", controller.controllertype]
+
+        if controller.bootable is not None:
+            cmdline.append("--bootable")
+            cmdline.append(controller.bootable)
+
+        contype = controller.controllertype
+        cmdline.append("--add")
+        if contype in ["PIIX4", "PIIX3", "ICH6"]:
+            cmdline.append("ide")
+        elif contype in ["I82078"]:
+            cmdline.append("floppy")
+        elif contype in ["IntelAhci"]:
+            cmdline.append("sata")
+        elif contype in ["LsiLogic", "BusLogic"]:
+            cmdline.append("scsi")
+        elif contype in ["LSILogicSAS", "BusLogic"]:
+            cmdline.append("sas")
+        elif contype in ["unknown"]:
+            #print("Not setting storage controller because type is unknown.")
+            return
+        else:
+            print("ERROR! Could not figure out controller type.")
+            sys.exit(1)
+
+        runcommand(cmdline)
+        self.invalidateinfo()
+        #print("Setting storrage controller option.")
 
-                if re.search("error", stderr, re.I):
-                    print("ERROR! Could not run command %s:\n%s" % (cmdline, stderr))
-                    sys.exit(1)
+    def plansteps(self, plan, progress=None, journal=None, graph=None, after=(), prefix="",
+            dryrun=False):
+        """
+        Add the steps that make this vm a clone of the vm plan was made
+        from to graph, a StepGraph (a new one if graph is None), and
+        return graph.  Every step comes after the steps named in after,
+        and the step names start with prefix.
+
+        Setting the options and the storage controllers and attaching the
+        devices all need this vm's session lock, so they are done one at a
+        time, but hard disks are copied alongside them.  Each device is
+        attached once its controller has been added and its hard disk (if
+        any) copied.  How the copies are getting on is reported to
+        progress, a ProgressReporter.  If journal is not None, steps it
+        has recorded are skipped or their results reused, and new ones are
+        recorded in it.
+
+        Copied hard disks are placed in plan's storage pools, or next to
+        this vm's settings file, after checking that there is room for
+        them.  Linked hard disks always go next to the settings file.
+
+        If dryrun is True, the steps are only going to be described, and
+        this vm may not exist yet.
+        """
+        if graph is None:
+            graph = StepGraph()
+        lock = "vm:%s" % self.uuid
+
+        def setoptions():
+            with phase("options"):
+                if journal is None or journal.get("options") is None:
+                    batch = OptionBatch(self.uuid)
+                    for option, value in plan.options.items():
+                        batch.add(option, value)
+                    batch.apply()
+                    if journal is not None:
+                        journal.record("options")
+
+        graph.add(prefix + "options", setoptions, after, lock,
+                description="modifyvm with %d options" % len(plan.options))
+
+        def setcontroller(controller):
+            with phase("controllers"):
+                step = "controller-%s" % controller.name
+                if journal is None or journal.get(step) is None:
+                    self.__setstoragecontroller(controller)
+                    if journal is not None:
+                        journal.record(step)
+
+        controllersteps = {}
+        for controller in plan.controllers:
+            controllersteps[controller.name] = graph.add(
+                    prefix + "controller-%s" % controller.name,
+                    lambda controller=controller: setcontroller(controller), after, lock,
+                    description="storagectl --add %s" % controller.controllertype)
+
+        pools = plan.pools
+        # the directory in a pool that this vm's disks go in
+        subdirectory = self.name
+        if plan.linked or pools is None:
+            pools = None
+            if not dryrun and plan.hdds():
+                # just look for the config file and assume we
+                # can throw the hdds in the same dir
+                configfile = self.cfgfile()
+                assert(os.path.isfile(configfile))
+                vmdirectory = os.path.dirname(configfile)
+                pools = plan.defaultpool(os.path.dirname(vmdirectory))
+                subdirectory = os.path.basename(vmdirectory)
+
+        def copydisk(hdd, newlocation, step, size):
+            with phase("disks"):
+                if plan.linked:
+                    copy = lambda: self.__linkhd(hdd, newlocation)
+                elif plan.fastcopy:
+                    copy = lambda: self.__fastcopyhd(hdd, newlocation, plan.fromvm, progress)
+                else:
+                    copy = lambda: self.__clonehd(hdd, newlocation, progress)
+                if pools is plan.pools and size:
+                    copy = lambda copy=copy: self.__timedcopy(copy, pools, newlocation, size)
+                if journal is not None:
+                    uuid = self.__journaledcopy(journal, step, newlocation, copy)
+                else:
+                    uuid = copy()
+
+                # add the new hdd to the forest and the media catalog
+                # without having to list all the hdds again
+                newhdd = getHDD(uuid, self.hddforest)
+                mediacatalog.add(Medium(newhdd.uuid, "hdd", newhdd.hdlocation))
+                return newhdd
+
+        def attach(cmdline, diskstep, step):
+            with phase("attach"):
+                newhdd = None
+                if diskstep is not None:
+                    newhdd = graph.results[diskstep]
+                    #print("Attaching new hard drive %s..." % newhdd.uuid)
+                    cmdline = cmdline + ["--medium", newhdd.uuid, "--type", "hdd"]
+                if journal is None or journal.get(step) is None:
+                    runcommand(cmdline)
+                    self.invalidateinfo()
+                    if journal is not None:
+                        journal.record(step)
+                if newhdd is not None:
+                    # the new hdd is now used by this vm
+                    self.hddforest.update(newhdd.uuid, hdvm=self.name, hdvmuuid=self.uuid)
 
+        cloned_hdds = 1
+        for i, (name, port, device, strgtype, medium) in enumerate(plan.attachments):
+            cmdline = ["VBoxManage", "storageattach", self.uuid,
+                "--storagectl", name,
+                "--port", port,
+                "--device", device]
+            description = "storageattach %s port %s device %s" % (name, port, device)
+            diskstep = None
+
+            if strgtype == "emptydrive":
+                # attach empty drive
+                #print("\tAttaching empty device to %s... " % name)
+                cmdline += ["--medium", "emptydrive"]
+            elif strgtype in ["dvd", "floppy", "hostdvd", "hostfloppy"]:
+                #print("\tAttaching %s to %s... " % (strgtype, name))
+                cmdline.append("--medium")
+                if strgtype in ["hostdvd", "hostfloppy"]:
+                    cmdline.append("host:%s" % medium)
+                else:
+                    cmdline.append("%s" % medium)
+
+                cmdline.append("--type")
+                if strgtype in ["dvd", "hostdvd"]:
+                    cmdline.append("dvddrive")
+                if strgtype in ["floppy", "hostfloppy"]:
+                    cmdline.append("floppy")
+            else:
+                hdd = medium
+                #print("hdd: %s" % hdd)
+                filename = "%s-%s.vdi" % (self.name, cloned_hdds)
+                step = "disk-%d" % cloned_hdds
                 cloned_hdds += 1
 
-                newhddforest = createHDDForest()
-                tmphdds = [hdd for hdd in newhddforest.values() if hdd.hdlocation == newlocation]
-                assert(len(tmphdds) == 1)
-                newhdd = tmphdds[0]
-                #print("new hdd: %s" % [hdd for hdd in newhddforest.values() if hdd.hdlocation == newlocation])
-
-                #print("Attaching new hard drive %s..." % newhdd.uuid)
-                cmdline = ["VBoxManage", "storageattach", self.uuid,
-                    "--storagectl", name,
-                    "--port", port,
-                    "--device", device,
-                    "--medium", newhdd.uuid,
-                    "--type", "hdd"]
-                runcommand(cmdline)
-
-    def setinfofrom(self, fromvm):
-        "Copy the info from the other vm to this vm."
-        options_to_copy = [
-                "accelerate3d",
-                "acpi",
-                "audio",
-                "boot1",
-                "boot2",
-                "boot3",
-                "boot4",
-                "clipboard",
-                "cpus",
-                "firmware",
-                "guestmemoryballoon",
-                "hpet"
-                "hwvirtex",
-                "hwvirtexexl",
-                "ioacpi",
-                "largepages",
-                "memory",
-                "monitorcount",
-                "nextedpaging",
-                "pae",
-                "rtcseutc",
-                "usb",
-                "usbehci",
-                "vram",
-                "vrdeaddress",
-                "vrdeauthtype",
-                "vrdeauthtype",
-                "vrdemulticon",
-                "vrdeport",
-                "vrdereusecon",
-                "vrdevideochannel",
-                "vrdevideochannelquality",
-                "vtxvpid",
-                ]
-
-        sys.stdout.write("Setting options for new VM from old VM (this may take a while)... ")
-        sys.stdout.flush()
+                if plan.linked:
+                    # children can only be added to a medium one at a time
+                    disklock = "medium:%s" % hdd.uuid
+                    size = 0
+                    cost = 2 * COMMAND_COST
+                    verb = "createhd --diffparent"
+                else:
+                    disklock = None
+                    size = self.__copysize(hdd) or 0
+                    verb = "copy" if plan.fastcopy else "clonehd"
+
+                done = journal.get(step) if journal is not None else None
+                if done is not None and done.get("location"):
+                    # an earlier run already put it somewhere
+                    newlocation = done["location"]
+                    directory = os.path.dirname(newlocation)
+                elif pools is not None:
+                    directory = pools.place(size, subdirectory)
+                    newlocation = os.path.join(directory, filename)
+                else:
+                    directory = None
+                    newlocation = filename
+
+                filesystem = None
+                if not dryrun:
+                    os.makedirs(directory, exist_ok=True)
+                    filesystem = filesystemof(directory)
+                if not plan.linked:
+                    rate = COPY_RATE
+                    if pools is not None:
+                        rate = pools.rateof(directory)
+                    cost = 2 * COMMAND_COST + size / rate
+                diskstep = graph.add(prefix + step,
+                        lambda hdd=hdd, newlocation=newlocation, step=step, size=size:
+                            copydisk(hdd, newlocation, step, size),
+                        after, disklock, filesystem, cost,
+                        "%s %s to %s" % (verb, hdd.uuid, newlocation))
+
+            dependencies = [controllersteps[name]]
+            if diskstep is not None:
+                dependencies.append(diskstep)
+            graph.add(prefix + "attach-%d" % i,
+                    lambda cmdline=cmdline, diskstep=diskstep, step="attach-%d" % i:
+                        attach(cmdline, diskstep, step),
+                    dependencies, lock, description=description)
+
+        return graph
+
+    def __journaledcopy(self, journal, step, newlocation, copy):
+        """
+        Reuse the hard disk at newlocation if journal says it was made by
+        step in an earlier run and it is still the same size and has the
+        same uuid.  Otherwise make it by calling copy, and record it in
+        journal.  Return the uuid of the hard disk.
+        """
+        done = journal.get(step)
+        if done is not None:
+            if self.__checkcopy(newlocation, done["uuid"], done["size"]):
+                print("Reusing %s from before." % newlocation)
+                return done["uuid"]
+            journal.forget(step)
+
+        if os.path.exists(newlocation):
+            # left behind by a copy that was interrupted
+            self.__removehd(newlocation)
+
+        uuid = copy()
+        if uuid == newlocation:
+            uuid = getHDD(newlocation).uuid
+        journal.record(step, uuid=uuid, size=os.path.getsize(newlocation), location=newlocation)
+        return uuid
+
+    def __timedcopy(self, copy, pools, newlocation, size):
+        "Call copy, and record how fast size bytes were written to newlocation in pools."
+        start = time.monotonic()
+        uuid = copy()
+        pools.recordrate(os.path.dirname(newlocation), size, time.monotonic() - start)
+        return uuid
+
+    def __checkcopy(self, location, uuid, size):
+        "Return True if the hard disk at location has uuid and is size bytes long."
+        try:
+            if os.path.getsize(location) != size:
+                return False
+        except OSError:
+            return False
+        stdout, error = trycommand(["VBoxManage", "showhdinfo", location])
+        if error:
+            return False
+        return HDD(stdout.strip().split("\n")).uuid == uuid
+
+    def __removehd(self, location):
+        "Remove the hard disk file at location, and unregister it if it is registered."
+        trycommand(["VBoxManage", "closemedium", "disk", location, "--delete"])
+        if os.path.exists(location):
+            try:
+                os.unlink(location)
+            except OSError as e:
+                print("ERROR! Could not remove %s left over from before: %s" % (location, e))
+                sys.exit(1)
 
-        for option in options_to_copy:
-            self.__setoption(fromvm, option)
+    def __clonehd(self, hdd, newlocation, progress=None):
+        """
+        Clone hdd to a new hard disk file at newlocation, reporting how it
+        is getting on to progress.  Return the uuid of the new hard disk,
+        or newlocation if VBoxManage didn't print the uuid.
+        """
+        cmdline = ["VBoxManage", "clonehd", hdd.uuid, newlocation]
+        #print("cmdline: %s" % cmdline)
+        if progress is None:
+            progress = ProgressReporter(quiet=True)
+        disk = progress.start(os.path.basename(newlocation), self.__copysize(hdd))
+        stdout, stderr = runwithprogress(cmdline,
+                lambda percent: progress.update(disk, percent))
+
+        if re.search("error", stderr, re.I):
+            print("ERROR! Could not run command %s:\n%s" % (cmdline, stderr))
+            sys.exit(1)
+
+        progress.finish(disk)
+
+        m = re.search(r'UUID: ([\w\d-]+)', stdout)
+        if m:
+            return m.group(1)
+        return newlocation
+
+    def __isidle(self, hdd, fromvm):
+        """
+        Return True if nothing can be writing to hdd, an hdd of fromvm:
+        going by its state, or if that isn't known (see hddstate() in
+        xmlinventory), by whether fromvm is powered off.
+        """
+        if hdd.hdstate is not None:
+            return hdd.hdstate == "created"
+        fromvm.fillininfo()
+        return hdd.hdvmuuid == fromvm.uuid and fromvm.info.get("vmstate") in ["poweroff", "aborted"]
 
-        print("Done.")
-        sys.stdout.write("Setting network options for new VM from old VM... ")
-        sys.stdout.flush()
+    def __fastcopyhd(self, hdd, newlocation, fromvm, progress=None):
+        """
+        Copy hdd's file to newlocation with copyimage() and give the copy
+        a new uuid, if hdd is a VDI file of fromvm that doesn't depend on a
+        parent and isn't in use.  Otherwise, or if the filesystem can't do
+        a fast copy, clone it with clonehd.  Return the uuid or the
+        location of the new hard disk, like __clonehd().
+        """
+        if (hdd.parentuuid != "base" or (hdd.hdformat or "").upper() != "VDI"
+                or not self.__isidle(hdd, fromvm) or not hdd.hdlocation):
+            return self.__clonehd(hdd, newlocation, progress)
+
+        if progress is None:
+            progress = ProgressReporter(quiet=True)
+        disk = progress.start(os.path.basename(newlocation), self.__copysize(hdd))
+        try:
+            method = copyimage(hdd.hdlocation, newlocation,
+                    lambda percent: progress.update(disk, percent))
+        except OSError as e:
+            print("WARNING: Could not copy %s: %s, using clonehd." % (hdd.hdlocation, e))
+            method = None
+        if method is None:
+            progress.cancel(disk)
+            return self.__clonehd(hdd, newlocation, progress)
+
+        # the copy still has the original's uuid, which VirtualBox won't
+        # accept twice
+        stdout, error = trycommand(["VBoxManage", "internalcommands", "sethduuid", newlocation])
+        if error:
+            print("WARNING: Could not give %s a new uuid, using clonehd:\n%s" % (newlocation, error))
+            os.unlink(newlocation)
+            progress.cancel(disk)
+            return self.__clonehd(hdd, newlocation, progress)
+        progress.finish(disk)
+
+        # VirtualBox registers the file when it is opened by location
+        return newlocation
+
+    def __copysize(self, hdd):
+        """
+        Return roughly how many bytes cloning hdd copies: the size of its
+        file and all the files in its differencing chain, which clonehd
+        merges.  Return None if they can't all be read.
+        """
+        try:
+            return sum(os.path.getsize(node.hdlocation)
+                    for node in self.hddforest.getchain(hdd.uuid))
+        except (KeyError, OSError, TypeError):
+            return None
 
-        multi_options_to_copy = [
-                "nic",
-                "nictype",
-                "cableconnected",
-                "bridgeadapter",
-                "hostonlyadapter",
-                "intnet",
-                "vdenet",
-                "natnet",
-                ]
-
-        # continue trying to set options until we get to a round where no options are set
-        i = 1
-        while True:
-            did_set_list = []
-            for option in multi_options_to_copy:
-                did_set_list.append(self.__setoption(fromvm, "%s%d" % (option, i)))
-            if not any(did_set_list):
-                break
-            i += 1
+    def __linkhd(self, hdd, newlocation):
+        """
+        Create a new differencing hard disk at newlocation whose parent is
+        hdd.  Return the uuid of the new hard disk, or newlocation if
+        VBoxManage didn't print the uuid.
+        """
+        stdout = runcommand(["VBoxManage", "createhd", "--filename", newlocation,
+            "--diffparent", hdd.uuid, "--format", "VDI"])
 
-        print("Done.")
-        sys.stdout.write("Setting storage controller options for new VM from old VM... ")
-        sys.stdout.flush()
+        m = re.search(r'UUID: ([\w\d-]+)', stdout)
+        if m:
+            return m.group(1)
+        return newlocation
 
-        i = 0
-        did_set_option = True
-        while did_set_option:
-            did_set_option = self.__setstoragecontrolleroption(fromvm,
-                    "storagecontrollername%d" %  i,
-                    "storagecontrollertype%d" %  i,
-                    "storagecontrollerbootable%d" %  i)
-            i += 1
+    def applyplan(self, plan, jobs=1, jobsperfs=None, progress=None, journal=None):
+        """
+        Make this vm a clone of the vm plan was made from.  Up to jobs
+        steps are done at the same time, and at most jobsperfs hard disks
+        are copied to the same filesystem at the same time.  jobsperfs may
+        be a GroupLimit shared with other clones.  progress is the
+        ProgressReporter that hard disk copies are reported to; by default
+        they are printed.  If journal is not None, the steps it has
+        recorded are skipped, and every step done is recorded in it.
+        """
+        if progress is None:
+            progress = ProgressReporter()
 
-        print("Done.")
-        sys.stdout.write("Copying storage devices for new VM from old VM (this may take a long time)... ")
+        sys.stdout.write("Copying settings and storage devices for new VM from old VM "
+                "(this may take a long time)... ")
         sys.stdout.flush()
 
-        self.__setstoragedevices(fromvm)
+        self.plansteps(plan, progress, journal).run(jobs, jobsperfs)
 
         print("Done.")
 
-def createNewVM(name, ostype, hddforest):
-    "Create a new VM with name and ostype.  Return new vm."
+    def setinfofrom(self, fromvm, jobs=1, jobsperfs=None, linked=False, progress=None,
+            fastcopy=False, journal=None, pools=None):
+        """
+        Copy the info from the other vm to this vm.  jobs and jobsperfs
+        limit how many hard disks are cloned at the same time, in total
+        and to each filesystem.  If linked is True, the new vm's hard
+        disks are differencing disks of the other vm's hard disks instead
+        of full copies.  progress is a ProgressReporter, as for applyplan().
+        If fastcopy is True, hard disks are copied by the filesystem where
+        possible, and pools is where they go, see ClonePlan.  journal is a
+        Journal, as for applyplan().
+        """
+        with phase("plan"):
+            plan = ClonePlan(fromvm, self.hddforest, linked, "Linked clone %s" % self.name,
+                    fastcopy, pools=pools)
+        self.applyplan(plan, jobs, jobsperfs, progress, journal)
+
+def createNewVM(name, ostype, hddforest, journal=None):
+    """
+    Create a new VM with name and ostype.  Return new vm.  If journal is
+    not None and has recorded creating the vm in an earlier run, the vm
+    from then is returned if it still exists.
+    """
+    if journal is not None:
+        created = journal.get("create")
+        if created is not None:
+            stdout, error = trycommand(["VBoxManage", "showvminfo", created["uuid"],
+                "--machinereadable"])
+            if not error:
+                print("Resuming the clone to vm %s from where it stopped." % name)
+                return VM('"%s" {%s}' % (name, created["uuid"]), hddforest)
+            # the vm has been removed since, so start again
+            journal.reset()
 
     sys.stdout.write("Creating new vm... ")
-    runcommand(["VBoxManage", "createvm", "--name", name, "--register", "--ostype", ostype])
+    with phase("create"):
+        stdout = runcommand(["VBoxManage", "createvm", "--name", name, "--register", "--ostype", ostype])
     print("Done.")
-    return getVM(hddforest, name)
+
+    # createvm tells us the uuid, so there is no need to list all the vms
+    m = re.search(r'^UUID: ([\w\d-]+)$', stdout, re.M)
+    if not m:
+        vm = getVM(hddforest, name)
+    else:
+        vm = VM('"%s" {%s}' % (name, m.group(1)), hddforest)
+    if journal is not None:
+        journal.record("create", uuid=vm.uuid)
+    return vm
+
+def describeclones(fromvm, names, hddforest, linked=False, fastcopy=False, pools=None):
+    """
+    Return a StepGraph of the steps of cloning fromvm to a new vm for
+    each name in names, for describing them, without changing anything.
+    """
+    plan = ClonePlan(fromvm, hddforest, linked, fastcopy=fastcopy, dryrun=True, pools=pools)
+    graph = StepGraph()
+    after = []
+    if linked and plan.hdds():
+        after = [graph.add("snapshot", None,
+            description="snapshot %s take" % fromvm.name)]
+    for name in names:
+        prefix = "%s:" % name if len(names) > 1 else ""
+        create = graph.add(prefix + "create", None, after,
+                description="createvm --name %s" % name)
+        # the vm doesn't exist yet, so it has no uuid
+        newvm = VM('"%s" {%s}' % (name, "new-%s" % len(graph)), hddforest)
+        newvm.plansteps(plan, graph=graph, after=[create], prefix=prefix, dryrun=True)
+    return graph
+
+def printVMs(vms):
+    "Print a list of existing VMs."
+    longest_vm = max([len(vm.name) for vm in vms])
+    for vm in vms:
+        print("%-*s  {%s}" % (longest_vm, vm.name,  vm.uuid))
 
 def getVM(hddforest, vmname=None):
     """
@@ -361,3 +781,45 @@ def getVM(hddforest, vmname=None):
     named_vms = [vm for vm in vms if vm.name == vmname or vm.uuid == vmname]
     assert(len(named_vms) == 1)
     return named_vms[0]
+
+def cloneVMs(fromvm, names, hddforest, jobs=1, jobsperfs=None, linked=False, progress=None,
+        fastcopy=False, pools=None):
+    """
+    Create a clone of fromvm for each name in names.  The plan for the
+    clones is only worked out once, and the steps of all the clones are
+    run as one StepGraph, so hard disks shared by the clones (like the
+    parents of linked clones) are only changed by one of them at a time,
+    and where all their disks go is decided before any is copied.
+    Up to jobs steps are run at the same time, and at most jobsperfs hard
+    disks are copied to the same filesystem at the same time; jobsperfs
+    may be a GroupLimit shared with other clones.  All the copies are
+    reported to progress, a ProgressReporter, so it shows their total
+    throughput.  fastcopy and pools are passed on to ClonePlan.  Each
+    clone keeps a Journal, so clones that were interrupted are resumed.
+    Return the list of new vms.
+    """
+    if progress is None:
+        progress = ProgressReporter()
+    with phase("plan"):
+        plan = ClonePlan(fromvm, hddforest, linked, fastcopy=fastcopy, pools=pools)
+
+    # the vms have to exist before their steps can be worked out
+    journals = [Journal.forclone(fromvm.uuid, name) for name in names]
+    newvms = runconcurrently([(None, lambda name=name, journal=journal:
+        createNewVM(name, plan.ostype, hddforest, journal))
+        for name, journal in zip(names, journals)], jobs)
+
+    graph = StepGraph()
+    for name, newvm, journal in zip(names, newvms, journals):
+        prefix = "%s:" % name if len(names) > 1 else ""
+        newvm.plansteps(plan, progress, journal, graph, prefix=prefix)
+
+    sys.stdout.write("Copying settings and storage devices for the new VMs from old VM "
+            "(this may take a long time)... ")
+    sys.stdout.flush()
+    graph.run(jobs, jobsperfs)
+    print("Done.")
+
+    for journal in journals:
+        journal.remove()
+    return newvms
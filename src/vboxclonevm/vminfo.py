@@ -0,0 +1,182 @@
+"""
+Module that deals with the information VirtualBox has about a VM.
+Provides the VMInfo class and a cache of VMInfo objects keyed by vm uuid.
+"""
+
+import re
+
+from vboxclonevm.utils import *
+
+class StorageDevice:
+    """
+    A port and device on a storage controller.  medium is what
+    showvminfo says is attached ("none", "emptydrive" or the location of
+    the image) and imageuuid is the uuid of the image or None.
+    """
+    def __init__(self, port, device, medium, imageuuid=None):
+        self.port = port
+        self.device = device
+        self.medium = medium
+        self.imageuuid = imageuuid
+
+    def __str__(self):
+        return "StorageDevice(port: %s, device: %s, medium: %s, imageuuid: %s)" % (
+                self.port, self.device, self.medium, self.imageuuid)
+
+    def __repr__(self):
+        return self.__str__()
+
+class StorageController:
+    """
+    A storage controller of a vm, with its devices in port and
+    device order.  bootable is None if the vm doesn't say whether the
+    controller is bootable.
+    """
+    def __init__(self, index, name, controllertype, bootable=None):
+        self.index = index
+        self.name = name
+        self.controllertype = controllertype
+        self.bootable = bootable
+        self.devices = []
+
+    def __str__(self):
+        return "StorageController(name: %s, type: %s, devices: %s)" % (
+                self.name, self.controllertype, self.devices)
+
+    def __repr__(self):
+        return self.__str__()
+
+class VMInfo(dict):
+    """
+    The options of a vm from the output of
+    `VBoxManage showvminfo --machinereadable`.  The keys are the option
+    names in lower case.
+
+    The options for storage controllers, their devices and the network
+    cards are also sorted out into storagecontrollers, a list of
+    StorageController objects, and nics, a dict mapping each nic index
+    to a dict of that nic's options, in index order.
+    """
+    # options that are given for each nic, with the nic index after them
+    nicoptions = [
+            "nic",
+            "nictype",
+            "cableconnected",
+            "bridgeadapter",
+            "hostonlyadapter",
+            "intnet",
+            "vdenet",
+            "natnet",
+            ]
+
+    nicre = re.compile(r'^(%s)(\d+)$' % "|".join(nicoptions))
+    controllerre = re.compile(r'^storagecontroller(name|type|bootable)(\d+)$')
+    imageuuidre = re.compile(r'^(.*)-imageuuid-(\d\d?)-(\d\d?)$')
+    devicere = re.compile(r'^(.*)-(\d\d?)-(\d\d?)$')
+
+    def __init__(self, stdout):
+        dict.__init__(self)
+
+        def create_values(line):
+            def take_out_quotes(string):
+                if len(string) <= 2:
+                    return string
+                if string[0] == '"':
+                    string = string[1:]
+                if string[-1] == '"':
+                    string = string[:-1]
+                return string
+
+            key, value = line.strip().split('=', 1)
+            return take_out_quotes(key), take_out_quotes(value)
+
+        for line in stdout.strip().split('\n'):
+            key, value = create_values(line)
+
+            # this is a hack because the value of firmware ("BIOS") is
+            # capitalized when it should not be.
+            if key.lower() == "firmware":
+                value = value.lower()
+
+            self[key.lower()] = value
+
+        self.__sortoptions()
+
+    def __sortoptions(self):
+        "Fill in storagecontrollers and nics from the options."
+        nics = {}
+        controllers = {}
+        # maps lower case controller name -> (port, device) -> [medium, imageuuid]
+        devices = {}
+
+        for key, value in self.items():
+            m = self.nicre.match(key)
+            if m:
+                nics.setdefault(int(m.group(2)), {})[key] = value
+                continue
+
+            m = self.controllerre.match(key)
+            if m:
+                controllers.setdefault(int(m.group(2)), {})[m.group(1)] = value
+                continue
+
+            m = self.imageuuidre.match(key)
+            if m:
+                device = devices.setdefault(m.group(1), {}).setdefault(
+                        (int(m.group(2)), int(m.group(3))), [None, None])
+                device[1] = value
+                continue
+
+            m = self.devicere.match(key)
+            if m:
+                device = devices.setdefault(m.group(1), {}).setdefault(
+                        (int(m.group(2)), int(m.group(3))), [None, None])
+                device[0] = value
+
+        self.nics = dict((index, nics[index]) for index in sorted(nics))
+
+        self.storagecontrollers = []
+        for index in sorted(controllers):
+            options = controllers[index]
+            if "name" not in options or "type" not in options:
+                continue
+            controller = StorageController(index, options["name"],
+                    options["type"], options.get("bootable"))
+            controllerdevices = devices.get(controller.name.lower(), {})
+            for port, device in sorted(controllerdevices):
+                medium, imageuuid = controllerdevices[(port, device)]
+                if medium is None:
+                    continue
+                controller.devices.append(StorageDevice(str(port), str(device),
+                    medium, imageuuid))
+            self.storagecontrollers.append(controller)
+
+    def cfgfile(self):
+        "Return the path to the vm's settings file."
+        return self["cfgfile"]
+
+    def ostype(self):
+        "Return the vm's os type."
+        return self["ostype"]
+
+    def controllers(self):
+        "Return a list of the vm's StorageController objects, in order."
+        return self.storagecontrollers
+
+# VMInfo objects that have already been read, keyed by vm uuid
+vminfocache = {}
+
+def getvminfo(vmuuid):
+    """
+    Return the VMInfo for the vm with uuid vmuuid.  `VBoxManage showvminfo`
+    is only run if the info isn't cached yet, or has been invalidated
+    with invalidatevminfo() since it was last read.
+    """
+    if vmuuid not in vminfocache:
+        stdout = runcommand(["VBoxManage", "showvminfo", vmuuid, "--machinereadable"])
+        vminfocache[vmuuid] = VMInfo(stdout)
+    return vminfocache[vmuuid]
+
+def invalidatevminfo(vmuuid):
+    "Forget the cached VMInfo for vmuuid.  Call this after changing the vm."
+    vminfocache.pop(vmuuid, None)
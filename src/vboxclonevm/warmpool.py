@@ -0,0 +1,207 @@
+"""
+Module that keeps clones of template vms made ahead of time, so a new
+vm can be handed out straight away by renaming one of them.  Provides
+the WarmPool class.
+
+The pooled clones of each template are listed in warmpool.json in the
+cache directory, along with the leaf hard disks the template had when
+they were made.  If the template's leaf hard disks change (because it
+was changed and a snapshot taken, say) the pooled clones are out of
+date, and are deleted the next time the pool is used.
+"""
+
+import contextlib
+import fcntl
+import json
+import os
+import tempfile
+import uuid as uuidmodule
+
+from vboxclonevm.pools import StoragePools
+from vboxclonevm.utils import *
+from vboxclonevm.vm import VM, cloneVMs
+from vboxclonevm.vminfo import invalidatevminfo
+
+class WarmPool:
+    """
+    The clones of template, a VM, that are ready to be handed out.
+    inventory is the Inventory the template and the clones are in.
+    """
+    def __init__(self, inventory, template, statefile=None):
+        if statefile is None:
+            statefile = os.path.join(cachedir(), "warmpool.json")
+        self.statefile = statefile
+        self.inventory = inventory
+        self.template = template
+
+    @contextlib.contextmanager
+    def __flock(self, lockname):
+        "Hold the lock file lockname next to the state file, waiting for other processes."
+        os.makedirs(os.path.dirname(self.statefile), exist_ok=True)
+        with open(lockname, "a") as lockfile:
+            fcntl.flock(lockfile, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lockfile, fcntl.LOCK_UN)
+
+    @contextlib.contextmanager
+    def __locked(self):
+        """
+        Hold the lock on the state file and yield the state of this
+        template's pool, which is written back afterwards.  The lock is
+        only held for a moment, so taking a clone never waits long.
+        """
+        with self.__flock(self.statefile + ".lock"):
+            states = {}
+            try:
+                with open(self.statefile) as f:
+                    states = json.load(f)
+            except (IOError, OSError, ValueError):
+                pass
+            state = states.setdefault(self.template.uuid, {"clones": []})
+            yield state
+
+            fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(self.statefile),
+                    prefix=".warmpool")
+            with os.fdopen(fd, "w") as f:
+                json.dump(states, f)
+            os.replace(tmpname, self.statefile)
+
+    def __filling(self):
+        "Return True if another process is filling the pool right now."
+        os.makedirs(os.path.dirname(self.statefile), exist_ok=True)
+        with open(self.statefile + ".fill.lock", "a") as lockfile:
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return True
+            fcntl.flock(lockfile, fcntl.LOCK_UN)
+            return False
+
+    def leaves(self):
+        "Return the sorted uuids of the leaf hard disks the template uses now."
+        return sorted(hdd.uuid for hdd in
+                hddsattachedto(self.template.uuid, self.inventory.forest))
+
+    def __prune(self, state, filling=False):
+        """
+        Remove the clones in state that no longer exist, and delete the
+        ones that were made from an older version of the template.
+        Return the clones that can be handed out.  If the pool is being
+        filled, a linked clone may just have changed the template's
+        leaves, so clones that look out of date are kept but not handed
+        out.
+        """
+        leaves = self.leaves()
+        existing = set(vm.uuid for vm in self.inventory.vms)
+        kept = []
+        usable = []
+        for clone in state["clones"]:
+            if clone["uuid"] not in existing:
+                continue
+            if clone["leaves"] != leaves:
+                if filling:
+                    kept.append(clone)
+                    continue
+                print("Deleting out of date pooled clone %s." % clone["name"])
+                stdout, error = trycommand(["VBoxManage", "unregistervm", clone["uuid"],
+                    "--delete"])
+                if error:
+                    print("WARNING: Could not delete %s:\n%s" % (clone["name"], error))
+                else:
+                    self.inventory.removevm(clone["uuid"])
+                continue
+            kept.append(clone)
+            usable.append(clone)
+        state["clones"] = kept
+        return usable
+
+    def ready(self):
+        "Return how many clones are ready to be handed out."
+        filling = self.__filling()
+        with self.__locked() as state:
+            return len(self.__prune(state, filling))
+
+    def take(self, newname):
+        """
+        Hand out one of the ready clones by renaming it newname.  Return
+        its VM, or None if there are none ready.
+        """
+        filling = self.__filling()
+        with self.__locked() as state:
+            usable = self.__prune(state, filling)
+            if not usable:
+                return None
+            clone = usable[0]
+            state["clones"].remove(clone)
+
+        runcommand(["VBoxManage", "modifyvm", clone["uuid"], "--name", newname])
+        invalidatevminfo(clone["uuid"])
+
+        forest = self.inventory.forest
+        for hdd in hddsattachedto(clone["uuid"], forest):
+            forest.update(hdd.uuid, hdvm=newname)
+        vm = VM('"%s" {%s}' % (newname, clone["uuid"]), forest)
+        self.inventory.addvm(vm)
+        return vm
+
+    def fill(self, size=None, jobs=1, linked=None, fastcopy=None, pools=None,
+            jobsperfs=None):
+        """
+        Make clones of the template until size of them are ready.  The
+        settings are remembered, and any that are None are taken from
+        the last time the pool was filled, so refill() can do the same.
+        jobs and jobsperfs are passed on to cloneVMs(), and pools is a
+        list of storage pool directories.  Return the number of clones
+        made.
+        """
+        # only one process fills the pools at a time, so two of them
+        # don't both make the missing clones
+        with self.__flock(self.statefile + ".fill.lock"):
+            with self.__locked() as state:
+                settings = state.setdefault("settings", {"size": 0, "linked": False,
+                    "fastcopy": False, "pools": []})
+                for key, value in [("size", size), ("linked", linked),
+                        ("fastcopy", fastcopy), ("pools", pools)]:
+                    if value is not None:
+                        settings[key] = value
+                settings = dict(settings)
+
+                missing = settings["size"] - len(self.__prune(state))
+                before = set(clone["uuid"] for clone in state["clones"])
+            if missing <= 0:
+                return 0
+
+            existing = set(vm.name for vm in self.inventory.vms)
+            names = []
+            while len(names) < missing:
+                name = "%s-pool-%s" % (self.template.name, uuidmodule.uuid4().hex[:8])
+                if name not in existing:
+                    names.append(name)
+
+            storagepools = None
+            if settings["pools"]:
+                storagepools = StoragePools(settings["pools"])
+            self.template.fillininfo()
+            newvms = cloneVMs(self.template, names, self.inventory.forest, jobs, jobsperfs,
+                    linked=settings["linked"], fastcopy=settings["fastcopy"],
+                    pools=storagepools)
+
+            with self.__locked() as state:
+                # a linked clone takes a snapshot of the template, which
+                # changes its leaves but not what is on them, so the
+                # clones that were ready before are still up to date
+                leaves = self.leaves()
+                for clone in state["clones"]:
+                    if clone["uuid"] in before:
+                        clone["leaves"] = leaves
+                for newvm in newvms:
+                    self.inventory.addvm(newvm)
+                    state["clones"].append({"name": newvm.name, "uuid": newvm.uuid,
+                        "leaves": leaves})
+            return len(newvms)
+
+    def refill(self, jobs=1, jobsperfs=None):
+        "Fill the pool back up with the settings it was last filled with."
+        return self.fill(jobs=jobs, jobsperfs=jobsperfs)
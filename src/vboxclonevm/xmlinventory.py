@@ -0,0 +1,174 @@
+"""
+Module that reads the VirtualBox inventory straight from VirtualBox's
+settings files, without running VBoxManage or talking to VBoxSVC.
+VirtualBox.xml lists the registered vms and the global media registry,
+and each vm's .vbox file has its own media registry and the storage
+controllers its hard disks are attached to.  The files are read with an
+incremental parser, so big media registries don't have to be held in
+memory as a whole tree.
+
+readinventory() makes the same VM objects and Forest of HDDs as
+`VBoxManage list vms` and `VBoxManage list hdds` would, except that the
+state of hdds that vms use isn't known.
+"""
+
+import os
+import sys
+
+from xml.etree.ElementTree import ParseError, iterparse
+
+from vboxclonevm.hdd import HDD, Forest
+from vboxclonevm.utils import *
+from vboxclonevm.vm import VM
+
+def localname(tag):
+    "Return tag without its {namespace}."
+    return tag.rpartition("}")[2]
+
+def stripbraces(uuid):
+    "Return uuid without the braces VirtualBox puts around it in its files."
+    return uuid.strip("{}")
+
+class SettingsFile:
+    """
+    What was read from one VirtualBox settings file: the vms registered
+    in it (for VirtualBox.xml), the machine it describes (for a .vbox
+    file), its hard disks and the hard disks its machine uses.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.directory = os.path.dirname(os.path.abspath(filename))
+        # list of settings file names of registered vms
+        self.machineentries = []
+        # the name and uuid of the machine, for .vbox files
+        self.machinename = None
+        self.machineuuid = None
+        # list of (uuid, parentuuid, format, location, type) tuples
+        self.hdds = []
+        # uuids of images attached to the current state of the machine
+        self.attached = set()
+        # maps uuids of images attached in snapshots to the first
+        # (name, uuid) of the snapshot they are attached in
+        self.snapshotattached = {}
+
+        self.__read()
+
+    def __read(self):
+        # stacks of the HardDisk and Snapshot elements we are inside of
+        hdds = []
+        snapshots = []
+        incontrollers = 0
+
+        for event, element in iterparse(self.filename, events=("start", "end")):
+            tag = localname(element.tag)
+            if event == "end":
+                if tag == "HardDisk":
+                    hdds.pop()
+                elif tag == "Snapshot":
+                    snapshots.pop()
+                elif tag == "StorageControllers":
+                    incontrollers -= 1
+                # nothing needs an element once it has ended
+                element.clear()
+                continue
+
+            if tag == "MachineEntry":
+                self.machineentries.append(element.get("src"))
+            elif tag == "Machine":
+                self.machinename = element.get("name")
+                self.machineuuid = stripbraces(element.get("uuid"))
+            elif tag == "HardDisk":
+                uuid = stripbraces(element.get("uuid"))
+                self.hdds.append((uuid, hdds[-1] if hdds else "base",
+                    element.get("format"), self.__path(element.get("location")),
+                    element.get("type", "Normal").lower()))
+                hdds.append(uuid)
+            elif tag == "Snapshot":
+                snapshots.append((element.get("name"), stripbraces(element.get("uuid"))))
+            elif tag == "StorageControllers":
+                incontrollers += 1
+            elif tag == "Image" and incontrollers:
+                uuid = stripbraces(element.get("uuid"))
+                if snapshots:
+                    self.snapshotattached.setdefault(uuid, snapshots[-1])
+                else:
+                    self.attached.add(uuid)
+
+    def __path(self, location):
+        "Return location, which may be relative to this file, as an absolute path."
+        if location is None:
+            return None
+        return os.path.normpath(os.path.join(self.directory, location))
+
+def readsettings(filename):
+    "Return a SettingsFile for filename, or exit if it can't be read."
+    try:
+        return SettingsFile(filename)
+    except (IOError, OSError, ParseError) as e:
+        print("ERROR! Could not read %s: %s" % (filename, e))
+        sys.exit(1)
+
+def hddstate(location, inuse):
+    """
+    Return the state VBoxManage would list for the hdd at location, or
+    None if the settings files can't tell.  The hdds a running vm uses
+    (and their parents) are locked, but only VBoxSVC knows which vms are
+    running, so if inuse is True the hdd may be locked.
+    """
+    if location is None or not os.path.exists(location):
+        return "inaccessible"
+    if inuse:
+        return None
+    return "created"
+
+def hddlines(uuid, parentuuid, hdformat, location, hdtype, usage, inuse):
+    """
+    Return the `VBoxManage list hdds` lines for an hdd.  inuse is True if
+    a vm or another hdd uses it.  If its state isn't known (see
+    hddstate()) there is no State line.
+    """
+    lines = ["UUID: %s" % uuid,
+            "Parent UUID: %s" % parentuuid,
+            "Storage format: %s" % hdformat,
+            "Location: %s" % location,
+            "Type: %s (%s)" % (hdtype, "base" if parentuuid == "base" else "differencing")]
+    state = hddstate(location, inuse)
+    if state is not None:
+        lines.append("State: %s" % state)
+    if usage:
+        lines.append("Usage: %s" % usage)
+    return lines
+
+def readinventory(home):
+    """
+    Read VirtualBox.xml in home and the settings files of the vms it
+    lists.  Return a tuple of the list of VM objects and the Forest of
+    all the hdds, in the same order as VBoxManage lists them.
+    """
+    vboxxml = readsettings(os.path.join(home, "VirtualBox.xml"))
+    machines = [readsettings(os.path.join(home, src)) for src in vboxxml.machineentries]
+
+    # like VBoxManage, only the first vm using an hdd is listed
+    usage = {}
+    for machine in machines:
+        for uuid in machine.attached:
+            usage.setdefault(uuid, "%s (UUID: %s)" % (machine.machinename, machine.machineuuid))
+    for machine in machines:
+        for uuid, (snapshotname, snapshotuuid) in machine.snapshotattached.items():
+            usage.setdefault(uuid, "%s (UUID: %s) [%s (UUID: %s)]" % (machine.machinename,
+                machine.machineuuid, snapshotname, snapshotuuid))
+
+    parents = set(parentuuid for settings in [vboxxml] + machines
+            for uuid, parentuuid, hdformat, location, hdtype in settings.hdds)
+
+    forest = Forest()
+    for settings in [vboxxml] + machines:
+        for uuid, parentuuid, hdformat, location, hdtype in settings.hdds:
+            if uuid in forest.nodes:
+                continue
+            forest[uuid] = HDD(hddlines(uuid, parentuuid, hdformat, location, hdtype,
+                usage.get(uuid), uuid in usage or uuid in parents), forest)
+
+    vms = [VM('"%s" {%s}' % (machine.machinename, machine.machineuuid), forest)
+            for machine in machines]
+    return vms, forest